@@ -0,0 +1,369 @@
+"""
+Benchmark the mysql3 store against a synthetic corpus.
+
+Generate a corpus of tiddlers, with tags, fields, geo fields and
+text drawn from skewed distributions, load it, then time put, get,
+list_bag_tiddlers, search (with and without fulltext), index_query
+and near: searches. Results, with throughput and p50 and p99
+latencies, are written as JSON, for comparing releases.
+
+By default a throwaway mysqld is started in a temporary directory
+and removed afterwards:
+
+    PYTHONPATH=. python bench/bench.py --sizes 10000,100000 \
+        --output results.json
+
+(PYTHONPATH=. picks up tiddlywebconfig.py, and through it this
+checkout of the plugin, when run from the top of the source tree.)
+
+Use --db-config to run against an existing (empty) database instead.
+The database is dropped and recreated.
+"""
+
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import MySQLdb
+
+from sqlalchemy.engine.url import make_url
+
+from tiddlyweb.config import config
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.store import Store
+
+import tiddlywebplugins.mysql3
+
+from tiddlywebplugins.mysql3 import Base, index_query
+from tiddlywebplugins.mysql3.migrate import add_fulltext
+
+
+WORDS = 5000
+TAGS = 500
+STATUSES = [u'draft', u'review', u'published', u'archived']
+GEO_SHARE = 0.2
+SAMPLES = 1000
+
+
+def main(args):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='10000',
+            help='comma separated corpus sizes [%default]')
+    parser.add_option('--db-config',
+            help='sqlalchemy url of a database to use, rather than '
+            'starting a throwaway mysqld')
+    parser.add_option('--mysqld', default='mysqld',
+            help='mysqld binary for the throwaway server [%default]')
+    parser.add_option('--samples', type='int', default=SAMPLES,
+            help='timed calls per operation [%default]')
+    parser.add_option('--seed', type='int', default=1,
+            help='random seed for the corpus [%default]')
+    parser.add_option('--output', help='file for the JSON results '
+            '[stdout]')
+    options, _ = parser.parse_args(args)
+
+    server = None
+    db_config = options.db_config
+    if not db_config:
+        server = Server(options.mysqld)
+        db_config = server.start()
+    try:
+        results = {'version': tiddlywebplugins.mysql3.__version__,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                    time.gmtime()),
+                'seed': options.seed,
+                'runs': []}
+        for size in [int(size) for size in options.sizes.split(',')]:
+            results['runs'].append(run(db_config, size, options.samples,
+                random.Random(options.seed)))
+    finally:
+        if server:
+            server.stop()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as results_file:
+            results_file.write(output + '\n')
+    else:
+        print output
+
+
+class Server(object):
+    """
+    A mysqld in a temporary directory, listening only on a socket.
+    """
+
+    def __init__(self, mysqld):
+        self.mysqld = mysqld
+        self.directory = tempfile.mkdtemp(prefix='mysql3bench')
+        self.datadir = os.path.join(self.directory, 'data')
+        self.socket = os.path.join(self.directory, 'mysqld.sock')
+        self.process = None
+
+    def start(self):
+        """
+        Initialize the data directory, start mysqld and wait for
+        it to accept connections. Return the db_config to use.
+        """
+        with open(os.path.join(self.directory, 'init.log'), 'w') as log:
+            subprocess.check_call([self.mysqld, '--no-defaults',
+                '--initialize-insecure', '--datadir=%s' % self.datadir],
+                stdout=log, stderr=subprocess.STDOUT)
+        self.process = subprocess.Popen([self.mysqld, '--no-defaults',
+            '--datadir=%s' % self.datadir, '--socket=%s' % self.socket,
+            '--skip-networking', '--innodb-buffer-pool-size=512M',
+            '--log-error=%s' % os.path.join(self.directory, 'error.log')])
+        for _ in range(300):
+            try:
+                MySQLdb.connect(user='root', unix_socket=self.socket).close()
+                break
+            except MySQLdb.OperationalError:
+                if self.process.poll() is not None:
+                    raise RuntimeError('mysqld exited, see %s'
+                            % self.directory)
+                time.sleep(0.1)
+        else:
+            raise RuntimeError('mysqld did not start, see %s'
+                    % self.directory)
+        return ('mysql://root@localhost/mysql3bench?unix_socket=%s'
+                '&charset=utf8&use_unicode=0' % self.socket)
+
+    def stop(self):
+        """
+        Stop mysqld and remove its directory.
+        """
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def run(db_config, size, samples, rand):
+    """
+    Load a corpus of size tiddlers into a fresh database and time
+    the operations on it.
+    """
+    _recreate_database(db_config)
+    _forget_database(db_config)
+    config['server_store'] = ['tiddlywebplugins.mysql3',
+            {'db_config': db_config}]
+    config['indexer'] = 'tiddlywebplugins.mysql3'
+    config['mysql.fulltext'] = True
+    config['mysql.fulltext_engine'] = 'InnoDB'
+    store = Store(config['server_store'][0], config['server_store'][1],
+            {'tiddlyweb.config': config})
+    environ = {'tiddlyweb.config': config, 'tiddlyweb.store': store}
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    connection = tiddlywebplugins.mysql3.ENGINE.connect()
+    try:
+        add_fulltext(connection, copy=True)
+    finally:
+        connection.close()
+
+    corpus = Corpus(rand, size)
+    for bag in corpus.bags:
+        store.put(Bag(bag))
+
+    timings = {}
+    start = time.time()
+    failures = store.storage.tiddlers_put_many(corpus.tiddlers(size))
+    load = time.time() - start
+    assert not failures, failures
+    timings['load'] = {'count': size, 'seconds': load,
+            'throughput': size / load}
+
+    puts = list(corpus.tiddlers(samples, prefix=u'put'))
+    timings['put'] = measure(lambda tiddler: store.put(tiddler), puts)
+    timings['get'] = measure(lambda key: store.get(Tiddler(key[1], key[0])),
+            [corpus.key() for _ in range(samples)])
+    timings['list_bag_tiddlers'] = measure(
+            lambda bag: list(store.list_bag_tiddlers(Bag(bag))),
+            [rand.choice(corpus.bags) for _ in range(samples)])
+
+    searches = [corpus.search() for _ in range(samples)]
+    timings['search_fulltext'] = measure(
+            lambda query: list(store.search(query)), searches)
+    config['mysql.fulltext'] = False
+    timings['search'] = measure(
+            lambda query: list(store.search(query)), searches)
+    config['mysql.fulltext'] = True
+
+    timings['index_query'] = measure(
+            lambda kwargs: list(index_query(environ, **kwargs)),
+            [corpus.filter() for _ in range(samples)])
+    timings['near'] = measure(lambda query: list(store.search(query)),
+            [corpus.near() for _ in range(samples)])
+
+    return {'size': size, 'bags': len(corpus.bags),
+            'server': store.storage.session.execute(
+                'SELECT VERSION()').scalar(),
+            'operations': timings}
+
+
+def measure(operation, arguments):
+    """
+    Call operation with each of arguments, reporting the count,
+    throughput (calls a second) and p50 and p99 latency (ms).
+    """
+    latencies = []
+    start = time.time()
+    for argument in arguments:
+        call_start = time.time()
+        operation(argument)
+        latencies.append(time.time() - call_start)
+    seconds = time.time() - start
+    latencies.sort()
+    return {'count': len(latencies), 'seconds': seconds,
+            'throughput': len(latencies) / seconds,
+            'p50': percentile(latencies, 50) * 1000,
+            'p99': percentile(latencies, 99) * 1000}
+
+
+def percentile(ordered, percent):
+    """
+    The nearest rank percentile of the sorted list ordered.
+    """
+    index = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(index, len(ordered) - 1))]
+
+
+class Corpus(object):
+    """
+    Synthetic tiddlers. Bags hold about a thousand tiddlers each.
+    Words and tags are drawn from Zipf like distributions, so a few
+    are very common and most are rare, as in real wikis.
+    """
+
+    def __init__(self, rand, size):
+        self.rand = rand
+        self.size = size
+        self.bags = [u'bag%04d' % index
+                for index in range(max(1, size // 1000))]
+        self.words = [u'word%d' % index for index in range(WORDS)]
+        self.tags = [u'tag%d' % index for index in range(TAGS)]
+        self.modifiers = [u'user%d' % index for index in range(100)]
+
+    def _zipf(self, choices):
+        """
+        Pick from choices, the earlier ones much more often.
+        """
+        index = int(len(choices) ** self.rand.random()) - 1
+        return choices[index]
+
+    def tiddlers(self, count, prefix=u'tiddler'):
+        """
+        Generate count tiddlers.
+        """
+        for index in xrange(count):
+            tiddler = Tiddler(u'%s%d' % (prefix, index),
+                    self.bags[index % len(self.bags)])
+            tiddler.modifier = self.rand.choice(self.modifiers)
+            tiddler.tags = list(set(self._zipf(self.tags)
+                for _ in range(self.rand.randint(0, 5))))
+            tiddler.fields[u'status'] = self.rand.choice(STATUSES)
+            tiddler.fields[u'priority'] = unicode(self.rand.randint(1, 5))
+            if self.rand.random() < GEO_SHARE:
+                tiddler.fields[u'geo.lat'] = u'%.6f' % self.rand.uniform(
+                        -60, 60)
+                tiddler.fields[u'geo.long'] = u'%.6f' % self.rand.uniform(
+                        -180, 180)
+            tiddler.text = u' '.join(self._zipf(self.words)
+                    for _ in range(self.rand.randint(20, 400)))
+            yield tiddler
+
+    def key(self):
+        """
+        The bag and title of a random loaded tiddler.
+        """
+        index = self.rand.randrange(self.size)
+        return (self.bags[index % len(self.bags)], u'tiddler%d' % index)
+
+    def search(self):
+        """
+        A random search, of the kinds seen from the web.
+        """
+        return self.rand.choice([
+            lambda: self._zipf(self.words),
+            lambda: u'%s %s' % (self._zipf(self.words),
+                self._zipf(self.words)),
+            lambda: u'tag:%s' % self._zipf(self.tags),
+            lambda: u'tag:%s status:%s' % (self._zipf(self.tags),
+                self.rand.choice(STATUSES)),
+            lambda: u'bag:%s %s' % (self.rand.choice(self.bags),
+                self._zipf(self.words)),
+            lambda: u'modifier:%s NOT tag:%s' % (
+                self.rand.choice(self.modifiers), self._zipf(self.tags)),
+            ])()
+
+    def filter(self):
+        """
+        Keyword arguments for a random index_query.
+        """
+        return self.rand.choice([
+            {'bag': self.rand.choice(self.bags)},
+            {'tag': self._zipf(self.tags)},
+            {'bag': self.rand.choice(self.bags),
+                'status': self.rand.choice(STATUSES)},
+            ])
+
+    def near(self):
+        """
+        A random near: search, radius 50 to 500km.
+        """
+        return u'near:%.4f,%.4f,%d' % (self.rand.uniform(-60, 60),
+                self.rand.uniform(-180, 180),
+                self.rand.randint(50000, 500000))
+
+
+def _recreate_database(db_config):
+    """
+    Drop and create the database named in db_config.
+    """
+    url = make_url(db_config)
+    connect_args = {'user': url.username or 'root'}
+    if url.password:
+        connect_args['passwd'] = url.password
+    if url.host and url.host != 'localhost':
+        connect_args['host'] = url.host
+    if url.port:
+        connect_args['port'] = url.port
+    if 'unix_socket' in url.query:
+        connect_args['unix_socket'] = url.query['unix_socket']
+    connection = MySQLdb.connect(**connect_args)
+    try:
+        cursor = connection.cursor()
+        cursor.execute('DROP DATABASE IF EXISTS `%s`' % url.database)
+        cursor.execute('CREATE DATABASE `%s` CHARACTER SET utf8'
+                % url.database)
+    finally:
+        connection.close()
+
+
+def _forget_database(db_config):
+    """
+    Dispose of the engines cached for db_config, whose pooled
+    connections were opened on the dropped database, so the next
+    Store connects to the new one.
+    """
+    database = tiddlywebplugins.mysql3.DATABASES.pop(db_config, None)
+    if database is None:
+        return
+    database.session.remove()
+    for engine in database.engines():
+        engine.dispose()
+    if tiddlywebplugins.mysql3.ENGINE is database.engine:
+        tiddlywebplugins.mysql3.ENGINE = None
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -24,7 +24,7 @@ setup(
     install_requires = ['setuptools',
         'tiddlyweb>=1.4.2',
         'tiddlywebplugins.sqlalchemy3>=3.1.0',
-        'sqlalchemy<0.9.0',
+        'sqlalchemy>=0.8.2,<0.9.0',
         'MySQL-python',
         ],
     zip_safe = False,
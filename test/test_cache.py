@@ -0,0 +1,31 @@
+import time
+
+from tiddlywebplugins.mysql3.cache import LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(2)
+    cache.put('one', 1)
+    cache.put('two', 2)
+    assert cache.get('one') == 1
+    cache.put('three', 3)
+
+    assert cache.get('two') is None
+    assert cache.get('one') == 1
+    assert cache.get('three') == 3
+    assert cache.stats() == {'hits': 3, 'misses': 1, 'size': 2}
+
+def test_validate():
+    cache = LRUCache(2)
+    cache.put('one', 1)
+
+    assert cache.get('one', lambda value: value == 2) is None
+    assert cache.get('one') is None
+    assert cache.stats() == {'hits': 0, 'misses': 2, 'size': 0}
+
+def test_ttl():
+    cache = LRUCache(2, ttl=0.01)
+    cache.put('one', 1)
+    assert cache.get('one') == 1
+    time.sleep(0.02)
+    assert cache.get('one') is None
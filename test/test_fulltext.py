@@ -0,0 +1,44 @@
+from tiddlyweb.config import config
+
+from tiddlywebplugins.utils import get_store
+
+import tiddlywebplugins.mysql3
+
+from tiddlywebplugins.mysql3 import Base, _check_fulltext
+from tiddlywebplugins.mysql3.migrate import add_fulltext
+
+
+def setup_module(module):
+    module.store = get_store(config)
+# delete everything
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+
+
+def _text_indexes(engine):
+    return dict((row['Key_name'], row['Index_type'])
+            for row in engine.execute('SHOW INDEX FROM text')
+            if row['Key_name'] != 'PRIMARY')
+
+
+def test_add_fulltext():
+    engine = tiddlywebplugins.mysql3.ENGINE
+    if 'tiddlytext' in _text_indexes(engine):
+        engine.execute('DROP INDEX tiddlytext ON text')
+    assert 'tiddlytext' not in _text_indexes(engine)
+
+    # Checking at startup only warns, leaving the table alone.
+    _check_fulltext(engine)
+    assert 'tiddlytext' not in _text_indexes(engine)
+
+    connection = engine.connect()
+    try:
+        assert add_fulltext(connection, copy=True)
+        assert _text_indexes(engine)['tiddlytext'] == 'FULLTEXT'
+
+        # Running it again leaves the one index alone.
+        before = _text_indexes(engine)
+        assert not add_fulltext(connection, copy=True)
+        assert _text_indexes(engine) == before
+    finally:
+        connection.close()
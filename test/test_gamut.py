@@ -11,10 +11,20 @@ from tiddlyweb.model.recipe import Recipe
 from tiddlyweb.model.tiddler import Tiddler
 from tiddlyweb.model.user import User
 
-from tiddlywebplugins.mysql3 import Base
+import tiddlywebplugins.mysql3
+
+from tiddlywebplugins.mysql3 import Base, get_tiddlers_from_recipe
+from tiddlywebplugins.mysql3 import sText
+from tiddlywebplugins.mysql3.model import (sRevisionArchive, sRevisionText,
+        sTextBlob)
+from tiddlywebplugins.mysql3.rows import TiddlerRow
+from tiddlywebplugins.sqlalchemy3 import Store as SQLStore
+from tiddlywebplugins.sqlalchemy3.model import current_revision_table
 
 from base64 import b64encode
 
+from sqlalchemy.exc import OperationalError
+
 #RANGE = 1000
 RANGE = 10
 
@@ -243,6 +253,15 @@ def test_list_tiddlers_no_bag():
     except AttributeError:
         assert True
 
+def test_list_tiddlers_closes_session():
+    bag = Bag(u'listed')
+    store.put(bag)
+    store.put(Tiddler(u'one', u'listed'))
+    tiddlers = list(store.list_bag_tiddlers(bag))
+    assert [tiddler.title for tiddler in tiddlers] == [u'one']
+    # No transaction, with its snapshot, is left holding a connection.
+    assert tiddlywebplugins.mysql3.ENGINE.pool.checkedout() == 0
+
 def xtest_case_sensitive():
     bag = Bag(u'testcs')
     store.put(bag)
@@ -387,6 +406,61 @@ def test_bag_deletes_tiddlers():
     py.test.raises(NoBagError, 'list(store.list_bag_tiddlers(bag))')
     py.test.raises(NoTiddlerError, 'store.list_tiddler_revisions(tiddler)')
 
+def test_batched_bag_delete():
+    store.put(Bag(u'batched'))
+    numbers = []
+    for x in xrange(5):
+        tiddler = Tiddler(u'batched%s' % x, u'batched')
+        tiddler.tags = [u'batched']
+        for text in (u'one', u'two'):
+            tiddler.text = text
+            store.put(tiddler)
+        numbers.extend(store.list_tiddler_revisions(tiddler))
+
+    config['mysql.batch_size'] = 2
+    try:
+        store.delete(Bag(u'batched'))
+    finally:
+        del config['mysql.batch_size']
+
+    py.test.raises(NoBagError, 'store.get(Bag(u"batched"))')
+    session = store.storage.session
+    assert session.query(sText).filter(
+            sText.revision_number.in_(numbers)).count() == 0
+    assert session.query(sRevisionText).filter(
+            sRevisionText.revision_number.in_(numbers)).count() == 0
+
+def test_bag_delete_failure_partway():
+    store.put(Bag(u'halfdeleted'))
+    for x in xrange(5):
+        tiddler = Tiddler(u'half%s' % x, u'halfdeleted')
+        tiddler.text = u'text'
+        store.put(tiddler)
+
+    storage = store.storage
+    delete_tiddlers = storage._delete_tiddlers
+    batches = []
+    def fail_second(tiddler_ids):
+        batches.append(tiddler_ids)
+        if len(batches) == 2:
+            raise OperationalError('delete', {}, 'Deadlock found')
+        delete_tiddlers(tiddler_ids)
+    storage._delete_tiddlers = fail_second
+    config['mysql.batch_size'] = 2
+    try:
+        py.test.raises(OperationalError, 'store.delete(Bag(u"halfdeleted"))')
+    finally:
+        del config['mysql.batch_size']
+        del storage._delete_tiddlers
+
+    # The bag is still there, with the tiddlers of the failed batch.
+    assert len(list(store.list_bag_tiddlers(Bag(u'halfdeleted')))) == 3
+
+    store.delete(Bag(u'halfdeleted'))
+    py.test.raises(NoBagError, 'store.get(Bag(u"halfdeleted"))')
+    py.test.raises(NoTiddlerError,
+            'store.get(Tiddler(u"half4", u"halfdeleted"))')
+
 def test_multi_same_tag_tiddler():
     bag = Bag(u'holder')
     store.put(bag)
@@ -426,6 +500,289 @@ def test_long_tiddler_title():
     py.test.raises(NoTiddlerError, 'store.get(tiddler1)')
     py.test.raises(NoTiddlerError, 'store.get(tiddler2)')
 
+def test_put_many():
+    store.put(Bag(u'many'))
+    long_title = u'x' * 200
+    tiddlers = []
+    for x in xrange(RANGE * 5):
+        tiddler = Tiddler(u'many%s' % (x % RANGE), u'many')
+        tiddler.text = u'text %s' % x
+        tiddler.tags = [u'tag%s' % x, u'common']
+        tiddler.fields[u'count'] = u'%s' % x
+        tiddlers.append(tiddler)
+    tiddlers.append(Tiddler(u'nobag', u'nosuchbag'))
+    tiddlers.append(Tiddler(long_title, u'many'))
+
+    failures = store.storage.tiddlers_put_many(tiddlers)
+
+    assert len(failures) == 2
+    assert isinstance(failures[0][1], NoBagError)
+    assert failures[0][0].title == 'nobag'
+    assert isinstance(failures[1][1], TypeError)
+    assert failures[1][0].title == long_title
+
+    for x in xrange(RANGE):
+        tiddler = store.get(Tiddler(u'many%s' % x, u'many'))
+        last = x + RANGE * 4
+        assert tiddler.text == 'text %s' % last
+        assert sorted(tiddler.tags) == ['common', 'tag%s' % last]
+        assert tiddler.fields['count'] == '%s' % last
+        assert tiddler.revision == tiddlers[last].revision
+        revisions = store.list_tiddler_revisions(tiddler)
+        assert len(revisions) == 5
+
+    py.test.raises(NoTiddlerError, 'store.get(Tiddler(long_title, u"many"))')
+
+def test_put_many_case_variant():
+    # The test database collation, like the default utf8 one, is
+    # case insensitive: these name the same bag and tiddler.
+    store.put(Bag(u'casebag'))
+    tiddler = Tiddler(u'CaseTitle', u'casebag')
+    tiddler.text = u'one'
+    store.put(tiddler)
+
+    variants = [Tiddler(u'casetitle', u'CASEBAG'),
+            Tiddler(u'CASETITLE', u'casebag'),
+            Tiddler(u'Other', u'casebag'),
+            Tiddler(u'OTHER', u'casebag')]
+    for index, variant in enumerate(variants):
+        variant.text = u'text %s' % index
+    assert store.storage.tiddlers_put_many(variants) == []
+
+    assert store.get(Tiddler(u'CaseTitle', u'casebag')).text == u'text 1'
+    assert store.get(Tiddler(u'other', u'casebag')).text == u'text 3'
+    assert len(list(store.list_bag_tiddlers(Bag(u'casebag')))) == 2
+    loaded = store.storage.tiddlers_get_many([Tiddler(u'casetitle',
+        u'CaseBag')])
+    assert [tiddler.text for tiddler in loaded] == [u'text 1']
+
+def test_shared_revision_text():
+    store.put(Bag(u'shared'))
+    tiddler = Tiddler(u'retagged', u'shared')
+    tiddler.text = u'the same text every time'
+    for tag in [u'one', u'two', u'three']:
+        tiddler.tags = [tag]
+        store.put(tiddler)
+    tiddler.text = u'new text'
+    store.put(tiddler)
+
+    session = store.storage.session
+    revisions = store.list_tiddler_revisions(tiddler)
+    assert session.query(sRevisionText).filter(
+            sRevisionText.revision_number.in_(revisions)).count() == 3
+    assert session.query(sRevisionText.hash).filter(
+            sRevisionText.revision_number.in_(revisions)).distinct(
+                    ).count() == 1
+    assert session.query(sText).filter(
+            sText.revision_number.in_(revisions)).count() == 1
+
+    for revision, tag in zip(revisions[1:], [u'three', u'two', u'one']):
+        old = Tiddler(u'retagged', u'shared')
+        old.revision = revision
+        old = store.get(old)
+        assert old.text == 'the same text every time'
+        assert old.tags == [tag]
+    assert store.get(Tiddler(u'retagged', u'shared')).text == 'new text'
+
+def test_archive_failure_after_put():
+    store.put(Bag(u'unarchived'))
+    tiddler = Tiddler(u'kept', u'unarchived')
+    tiddler.text = u'first text'
+    store.put(tiddler)
+    first = tiddler.revision
+
+    def fail(numbers):
+        raise OperationalError('archive', {}, 'Lock wait timeout exceeded')
+    store.storage._archive_texts = fail
+    try:
+        tiddler.text = u'second text'
+        store.put(tiddler)
+    finally:
+        del store.storage._archive_texts
+
+    assert store.get(Tiddler(u'kept', u'unarchived')).text == u'second text'
+    session = store.storage.session
+    assert session.query(sText).filter(
+            sText.revision_number == first).count() == 1
+
+    store.storage.archive_texts()
+    assert session.query(sText).filter(
+            sText.revision_number == first).count() == 0
+    old = Tiddler(u'kept', u'unarchived')
+    old.revision = first
+    assert store.get(old).text == u'first text'
+
+def test_blob_tiddlers():
+    store.put(Bag(u'blobs'))
+    image = '\x89PNG\r\n\x1a\n\x00\xff' * 100
+    tiddler = Tiddler(u'image', u'blobs')
+    tiddler.type = 'image/png'
+    tiddler.text = image
+    store.put(tiddler)
+    assert store.get(Tiddler(u'image', u'blobs')).text == image
+
+    config['mysql.compress_threshold'] = 1000
+    try:
+        text = u'a long and repetitive text ' * 100
+        tiddler = Tiddler(u'long', u'blobs')
+        tiddler.text = text
+        store.put(tiddler)
+    finally:
+        del config['mysql.compress_threshold']
+    assert store.get(Tiddler(u'long', u'blobs')).text == text
+
+    session = store.storage.session
+    compressed = dict(session.query(sTextBlob.revision_number,
+        sTextBlob.compressed))
+    assert compressed[tiddler.revision]
+    assert session.query(sText.text).filter(
+            sText.revision_number == tiddler.revision).scalar() == ''
+
+def test_prune_revisions():
+    store.put(Bag(u'pruned'))
+    tiddler = Tiddler(u'many', u'pruned')
+    for index in range(6):
+        tiddler.text = u'text %s' % index
+        tiddler.tags = [u'tag%s' % index]
+        tiddler.fields[u'index'] = u'%s' % index
+        store.put(tiddler)
+    revisions = store.list_tiddler_revisions(tiddler)
+
+    # The archive copies are read in one go, not one tiddler_get each.
+    def refuse(self, tiddler):
+        raise AssertionError('tiddler_get while archiving')
+    tiddler_get = SQLStore.tiddler_get
+    SQLStore.tiddler_get = refuse
+    store.storage.store_config['revision_retention'] = {'keep': 2,
+            'archive': True}
+    try:
+        assert store.storage.prune_revisions(tiddler) == 3
+    finally:
+        SQLStore.tiddler_get = tiddler_get
+        del store.storage.store_config['revision_retention']
+    assert store.list_tiddler_revisions(tiddler) == (revisions[:2]
+            + revisions[-1:])
+    assert store.get(Tiddler(u'many', u'pruned')).text == u'text 5'
+
+    session = store.storage.session
+    archived = session.query(sRevisionArchive).order_by(
+            sRevisionArchive.number).all()
+    assert [row.number for row in archived] == sorted(revisions[2:5])
+    assert archived[0].text == u'text 1'
+    assert archived[0].tags == u'["tag1"]'
+    assert archived[0].fields == u'{"index": "1"}'
+
+def test_prune_failure_after_put():
+    tiddler = Tiddler(u'many', u'pruned')
+    tiddler.text = u'text 6'
+    store.storage.store_config['revision_retention'] = {'keep': 1,
+            'on_write': True}
+
+    def fail(tiddler):
+        raise OperationalError('prune', {}, 'Lock wait timeout exceeded')
+    store.storage.prune_revisions = fail
+    try:
+        store.put(tiddler)
+    finally:
+        del store.storage.prune_revisions
+        del store.storage.store_config['revision_retention']
+
+    assert store.get(Tiddler(u'many', u'pruned')).text == u'text 6'
+    assert len(store.list_tiddler_revisions(tiddler)) == 4
+
+def test_recipe_tiddlers():
+    for name, titles in [(u'rbag1', u'abc'), (u'rbag2', u'bcd')]:
+        store.put(Bag(name))
+        for title in titles:
+            tiddler = Tiddler(title, name)
+            tiddler.tags = title == u'b' and [u'keep'] or []
+            store.put(tiddler)
+    store.put(Bag(u'rbagempty'))
+
+    recipe = Recipe(u'resolved')
+    recipe.set_recipe([(u'rbag1', u''), (u'rbagempty', u''),
+        (u'rbag2', u'select=tag:keep')])
+    store.put(recipe)
+    tiddlers = get_tiddlers_from_recipe(store.get(recipe),
+            {'tiddlyweb.config': config, 'tiddlyweb.store': store})
+    assert sorted((tiddler.title, tiddler.bag) for tiddler in tiddlers) == [
+            (u'a', u'rbag1'), (u'b', u'rbag2'), (u'c', u'rbag1')]
+
+    # The same bag twice, named in different case.
+    recipe.set_recipe([(u'RBag1', u''), (u'rbag2', u''), (u'rbag1', u'')])
+    tiddlers = store.storage.recipe_tiddlers(recipe.get_recipe())
+    assert sorted((tiddler.title, tiddler.bag) for tiddler in tiddlers) == [
+            (u'a', u'rbag1'), (u'b', u'rbag1'), (u'c', u'rbag1'),
+            (u'd', u'rbag2')]
+
+    recipe.set_recipe([(u'rbag1', u''), (u'rbagmissing', u'')])
+    py.test.raises(NoBagError, 'store.storage.recipe_tiddlers('
+            'recipe.get_recipe())')
+
+def test_tiddlers_get_many():
+    store.put(Bag(u'many'))
+    for index in range(3):
+        tiddler = Tiddler(u'many%s' % index, u'many')
+        tiddler.text = u'many text %s' % index
+        tiddler.tags = [u'manytag']
+        tiddler.fields[u'index'] = unicode(index)
+        store.put(tiddler)
+    tiddler.text = u'many text again'
+    store.put(tiddler)
+
+    tiddlers = store.storage.tiddlers_get_many([Tiddler(u'many%s' % index,
+        u'many') for index in range(4)])
+    assert [tiddler.title for tiddler in tiddlers] == [u'many0', u'many1',
+            u'many2']
+    for tiddler in tiddlers:
+        stored = store.get(Tiddler(tiddler.title, u'many'))
+        for attribute in ('revision', 'modified', 'modifier', 'created',
+                'creator', 'type', 'text', 'tags', 'fields'):
+            assert getattr(tiddler, attribute) == getattr(stored, attribute)
+
+    config['mysql.search_load'] = True
+    try:
+        tiddlers = list(store.search(u'bag:many tag:manytag'))
+    finally:
+        del config['mysql.search_load']
+    assert sorted(tiddler.text for tiddler in tiddlers) == [u'many text 0',
+            u'many text 1', u'many text again']
+
+def test_tiddler_rows():
+    rows = list(store.storage.list_bag_tiddlers(Bag(u'many'), rows=True))
+    assert sorted(row.title for row in rows) == [u'many0', u'many1',
+            u'many2']
+    for row in rows:
+        stored = store.get(Tiddler(row.title, u'many'))
+        assert isinstance(row, TiddlerRow)
+        assert row.revision == stored.revision
+        assert row.modified == stored.modified
+        assert row.tags == stored.tags
+        assert row._text is None
+        assert row.text == stored.text
+
+    rows = list(store.storage.search(u'bag:many tag:manytag', rows=True))
+    assert len(rows) == 3
+    assert isinstance(rows[0], TiddlerRow)
+
+def test_check_current_revisions():
+    assert store.storage.check_current_revisions() == []
+
+    tiddler = store.get(Tiddler(u'many2', u'many'))
+    first = store.list_tiddler_revisions(tiddler)[-1]
+    session = store.storage.session
+    session.execute(current_revision_table.update().where(
+        current_revision_table.c.current_id == tiddler.revision).values(
+            current_id=first))
+    session.commit()
+    wrong = store.storage.check_current_revisions()
+    assert [(current, highest) for _, current, highest in wrong] == [
+            (first, tiddler.revision)]
+
+    assert store.storage.check_current_revisions(repair=True) == wrong
+    assert store.storage.check_current_revisions() == []
+    assert store.get(Tiddler(u'many2', u'many')).text == u'many text again'
+
 @py.test.mark.xfail
 def test_emoji_title():
     """
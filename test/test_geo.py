@@ -72,3 +72,30 @@ def test_find_toilet():
 
     tiddlers = list(store.search(u'near:10,-10,100000 tag:toilet'))
     assert len(tiddlers) == 0
+
+def test_geo_follows_tiddler():
+    tiddler = store.get(Tiddler(u'place1', u'bag1'))
+    tiddler.fields[u'geo.lat'] = u'60.5'
+    tiddler.fields[u'geo.long'] = u'-60.5'
+    store.put(tiddler)
+
+    tiddlers = list(store.search(u'near:10,-10,100000'))
+    assert len(tiddlers) == 0
+    tiddlers = list(store.search(u'near:60,-60,100000'))
+    assert len(tiddlers) == 1
+
+    tiddler.fields[u'geo.lat'] = u'somewhere'
+    store.put(tiddler)
+    tiddlers = list(store.search(u'near:60,-60,100000'))
+    assert len(tiddlers) == 0
+
+    tiddler.fields[u'geo.lat'] = u'10.5'
+    tiddler.fields[u'geo.long'] = u'-10.5'
+    store.put(tiddler)
+    store.storage.sync_geo()
+    tiddlers = list(store.search(u'near:10,-10,100000'))
+    assert len(tiddlers) == 1
+
+    store.delete(tiddler)
+    tiddlers = list(store.search(u'near:10,-10,100000'))
+    assert len(tiddlers) == 0
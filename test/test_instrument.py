@@ -0,0 +1,38 @@
+from tiddlywebplugins.mysql3.instrument import (TIMINGS, count_statement,
+        timed)
+
+
+def setup_module(module):
+    TIMINGS.clear()
+
+def test_timed_call():
+    @timed
+    def put(value):
+        count_statement()
+        count_statement()
+        return value
+
+    assert put(5) == 5
+    report = TIMINGS.report()['put']
+    assert report['count'] == 1
+    assert report['statements'] == 2
+    assert sum(count for bound, count in report['histogram']) == 1
+    assert report['histogram'][-1][0] is None
+
+def test_timed_generator():
+    @timed
+    def listing():
+        for value in range(3):
+            count_statement()
+            yield value
+
+    results = listing()
+    assert 'listing' not in TIMINGS.report()
+    assert list(results) == [0, 1, 2]
+    assert TIMINGS.report()['listing']['statements'] == 3
+
+    results = listing()
+    results.next()
+    results.close()
+    assert TIMINGS.report()['listing']['count'] == 2
+    assert TIMINGS.report()['listing']['statements'] == 4
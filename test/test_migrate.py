@@ -0,0 +1,84 @@
+import py.test
+
+from tiddlyweb.config import config
+from tiddlyweb.store import StoreError
+
+from tiddlywebplugins.utils import get_store
+
+import tiddlywebplugins.mysql3
+
+from tiddlywebplugins.mysql3 import Base
+from tiddlywebplugins.mysql3.migrate import (MIGRATIONS, migrate, plan,
+        schema_version)
+from tiddlywebplugins.mysql3.model import sSchemaVersion
+
+
+def setup_module(module):
+    module.store = get_store(config)
+# delete everything
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+
+
+def test_migrate_current_schema():
+    connection = tiddlywebplugins.mysql3.ENGINE.connect()
+    try:
+        assert schema_version(connection) == 0
+        pending = plan(connection)
+        assert [number for number, _, _ in pending] == [
+                number for number, _, _ in MIGRATIONS]
+        assert [statements for _, _, statements in pending] == [
+                [] for _ in MIGRATIONS]
+
+        migrate(connection)
+        assert schema_version(connection) == MIGRATIONS[-1][0]
+        assert plan(connection) == []
+    finally:
+        connection.close()
+
+
+def test_migrate_adds_index():
+    connection = tiddlywebplugins.mysql3.ENGINE.connect()
+    try:
+        connection.execute('ALTER TABLE field DROP INDEX ix_field_name_value')
+        connection.execute(sSchemaVersion.__table__.delete().where(
+            sSchemaVersion.version == 3))
+        assert plan(connection) == [(3, MIGRATIONS[2][1],
+            ['ALTER TABLE `field` ADD INDEX `ix_field_name_value` '
+                '(`name`, `value`(191))'])]
+
+        assert migrate(connection) == [3]
+        assert plan(connection) == []
+    finally:
+        connection.close()
+
+
+def _tag_column(connection):
+    return tuple(connection.execute(
+            "SELECT COLUMN_TYPE, COLLATION_NAME "
+            "FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'tag' "
+            "AND COLUMN_NAME = 'tag'").first())
+
+
+def test_migrate_copies_to_narrow_column():
+    connection = tiddlywebplugins.mysql3.ENGINE.connect()
+    try:
+        # As made by an earlier release, with a collation of its own.
+        connection.execute('ALTER TABLE tag MODIFY COLUMN tag '
+                'VARCHAR(255) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL')
+        connection.execute(sSchemaVersion.__table__.delete().where(
+            sSchemaVersion.version == 1))
+        assert plan(connection) == [(1, MIGRATIONS[0][1],
+            ['ALTER TABLE `tag` MODIFY COLUMN `tag` VARCHAR(191) '
+                'CHARACTER SET utf8 COLLATE utf8_bin NOT NULL'])]
+
+        # Narrowing a column copies the table, so needs copy.
+        py.test.raises(StoreError, 'migrate(connection)')
+        assert _tag_column(connection) == ('varchar(255)', 'utf8_bin')
+
+        assert migrate(connection, copy=True) == [1]
+        assert _tag_column(connection) == ('varchar(191)', 'utf8_bin')
+        assert plan(connection) == []
+    finally:
+        connection.close()
@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import create_engine
+
+from tiddlywebplugins.mysql3 import on_checkout
+from tiddlywebplugins.mysql3.pool import (TimedQueuePool, after_fork,
+        check_pid, on_checkin, on_connect)
+
+
+class PingedConnection(object):
+    """
+    A sqlite connection which counts pings, as mysqld would get
+    them, and can fail them as if the server had gone away.
+    """
+
+    class OperationalError(Exception):
+        pass
+
+    def __init__(self, gone=False):
+        self.connection = sqlite3.connect(':memory:')
+        self.gone = gone
+        self.pings = 0
+        self.closed = False
+
+    def ping(self, reconnect):
+        self.pings += 1
+        if self.gone:
+            raise self.OperationalError(2006, 'MySQL server has gone away')
+
+    def close(self):
+        self.closed = True
+        self.connection.close()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def _engine(**kwargs):
+    engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+            pool_size=1, max_overflow=-1, **kwargs)
+    event.listen(engine, 'connect', on_connect)
+    event.listen(engine, 'checkin', on_checkin)
+    event.listen(engine, 'checkout',
+            lambda dbapi_con, con_record, con_proxy:
+                check_pid(con_record, con_proxy))
+    return engine
+
+def _pinged_engine(connections, ping_idle, gone=0):
+    """
+    An engine of PingedConnections, kept in connections, of which
+    the first gone have gone away.
+    """
+    def creator():
+        connection = PingedConnection(gone=len(connections) < gone)
+        connections.append(connection)
+        return connection
+    engine = create_engine('sqlite://', poolclass=TimedQueuePool,
+            pool_size=1, max_overflow=-1, creator=creator,
+            ping_idle=ping_idle)
+    event.listen(engine, 'connect', on_connect)
+    event.listen(engine, 'checkin', on_checkin)
+    event.listen(engine, 'checkout', on_checkout)
+    return engine
+
+def test_pool_report():
+    engine = _engine()
+    first = engine.connect()
+    second = engine.connect()
+    report = engine.pool.report()
+    assert report['checkouts'] == 2
+    assert report['checkedout'] == 2
+    assert report['overflow'] == 1
+    assert report['max_wait'] <= report['wait']
+
+    first.close()
+    second.close()
+    engine.dispose()
+    report = engine.pool.report()
+    assert report['checkouts'] == 2
+    assert report['checkedout'] == 0
+    assert report['overflow'] == 0
+
+def test_idle_since():
+    engine = _engine(ping_idle=5)
+    assert engine.pool.ping_idle == 5
+    connection = engine.connect()
+    idle_since = connection.connection.info['idle_since']
+    time.sleep(0.01)
+    connection.close()
+    connection = engine.connect()
+    assert connection.connection.info['idle_since'] > idle_since
+
+def test_ping_skipped_when_recently_idle():
+    connections = []
+    engine = _pinged_engine(connections, ping_idle=5)
+    for _ in range(3):
+        engine.connect().close()
+    assert [connection.pings for connection in connections] == [0]
+    assert engine.pool.report()['pings'] == 0
+
+def test_ping_when_idle_too_long():
+    connections = []
+    engine = _pinged_engine(connections, ping_idle=0.05)
+    engine.connect().close()
+    time.sleep(0.1)
+    engine.connect().close()
+    assert [connection.pings for connection in connections] == [1]
+    assert engine.pool.report()['pings'] == 1
+
+    # Always pinged without ping_idle.
+    connections = []
+    engine = _pinged_engine(connections, ping_idle=0)
+    engine.connect().close()
+    engine.connect().close()
+    assert [connection.pings for connection in connections] == [2]
+
+def test_ping_replaces_dead_connection():
+    connections = []
+    engine = _pinged_engine(connections, ping_idle=0.05, gone=1)
+    engine.connect().close()
+    time.sleep(0.1)
+    connection = engine.connect()
+    assert len(connections) == 2
+    assert connections[0].closed
+    assert connection.connection.connection is connections[1]
+    report = engine.pool.report()
+    assert report['pings'] == 1
+    assert report['disconnects'] == 1
+
+def test_fork():
+    engine = _engine()
+    connection = engine.connect()
+    connection.close()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            connection = engine.connect()
+            if connection.connection.info['pid'] == os.getpid():
+                after_fork(engine)
+                if engine.pool.report()['checkouts'] == 0:
+                    status = 0
+        finally:
+            os._exit(status)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert engine.connect().connection.info['pid'] == os.getpid()
@@ -0,0 +1,64 @@
+from tiddlyweb.config import config
+from tiddlyweb.store import Store
+
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.model.bag import Bag
+
+from tiddlywebplugins.utils import get_store
+
+from tiddlywebplugins.mysql3 import Base, pool_stats
+
+
+def setup_module(module):
+    writer = get_store(config)
+# delete everything
+    Base.metadata.drop_all()
+    Base.metadata.create_all()
+    writer.put(Bag(u'replicated'))
+    writer.put(Tiddler(u'one', u'replicated'))
+
+    # The test database is its own replica. The primary is named
+    # by an equivalent db_config, so it gets engines of its own
+    # rather than those made, without replicas, for other tests.
+    db_config = config['server_store'][1]['db_config']
+    module.primary = db_config.replace('mysql:///', 'mysql://localhost/')
+    module.store = Store('tiddlywebplugins.mysql3',
+            {'db_config': module.primary, 'db_replicas': [db_config]},
+            {'tiddlyweb.config': config})
+
+
+def _checkouts():
+    stats = pool_stats(primary)
+    return stats['primary']['checkouts'], stats['replicas'][0]['checkouts']
+
+
+def test_reads_use_replica():
+    storage = store.storage
+    assert storage.read_session is not None
+    assert storage._read_session() is storage.read_session
+
+    primary_before, replica_before = _checkouts()
+    assert store.get(Tiddler(u'one', u'replicated')).title == u'one'
+    assert [tiddler.title for tiddler in
+            store.list_bag_tiddlers(Bag(u'replicated'))] == [u'one']
+    assert [tiddler.title for tiddler in
+            store.search(u'bag:replicated')] == [u'one']
+    primary_after, replica_after = _checkouts()
+
+    assert primary_after == primary_before
+    assert replica_after > replica_before
+
+
+def test_reads_after_write_use_primary():
+    storage = store.storage
+    store.put(Tiddler(u'two', u'replicated'))
+    assert storage._read_session() is storage.session
+
+    primary_before, replica_before = _checkouts()
+    assert store.get(Tiddler(u'two', u'replicated')).title == u'two'
+    assert sorted(tiddler.title for tiddler in
+            store.search(u'bag:replicated')) == [u'one', u'two']
+    primary_after, replica_after = _checkouts()
+
+    assert primary_after > primary_before
+    assert replica_after == replica_before
@@ -1,12 +1,21 @@
+import threading
+
 import py.test
 from tiddlyweb.config import config
+from tiddlyweb.filters import FilterIndexRefused
+from tiddlyweb.store import Store, StoreError
 
 from tiddlyweb.model.tiddler import Tiddler
 from tiddlyweb.model.bag import Bag
 
 from tiddlywebplugins.utils import get_store
 
-from tiddlywebplugins.mysql3 import index_query
+import tiddlywebplugins.mysql3
+
+from tiddlywebplugins.mysql3 import index_query, after_token, cache_stats
+from tiddlywebplugins.mysql3.cache import LRUCache
+from tiddlywebplugins.mysql3.migrate import add_fulltext
+from tiddlywebplugins.mysql3.model import sBagGeneration
 from tiddlywebplugins.mysql3 import Base
 
 def setup_module(module):
@@ -82,6 +91,14 @@ def test_index_query_filter_fields():
     assert tiddlers[0].bag == 'bag1'
     assert tiddlers[0].fields['house'] == 'cottage'
 
+def test_index_query_refused():
+    # A malformed _after token only fails once the search runs.
+    for mode in ['_rows', '_count', None]:
+        kwords = {'_after': u'nonsense'}
+        if mode:
+            kwords[mode] = True
+        py.test.raises(FilterIndexRefused, index_query, environ, **kwords)
+
 def test_search_right_revision():
     tiddler = Tiddler(u'revised', u'bag1')
     tiddler.text = u'alpha'
@@ -213,6 +230,72 @@ def test_limited_search():
     tiddlers = list(store.search(u'starts _limit:so'))
     assert len(tiddlers) != 1, tiddlers
 
+def test_keyset_search():
+    store.put(Bag(u'paged'))
+    for x in xrange(7):
+        tiddler = Tiddler(u'page%s' % x, u'paged')
+        tiddler.text = u'paged text'
+        store.put(tiddler)
+
+    tiddlers = list(store.search(u'bag:paged _sort:key _limit:3'))
+    titles = [tiddler.title for tiddler in tiddlers]
+    assert titles == ['page0', 'page1', 'page2']
+    while tiddlers:
+        tiddlers = list(store.search(u'bag:paged _after:%s _limit:3'
+            % after_token(tiddlers[-1])))
+        titles.extend(tiddler.title for tiddler in tiddlers)
+    assert titles == ['page%s' % x for x in xrange(7)]
+
+    py.test.raises(StoreError, 'list(store.search(u"_after:@@@@"))')
+
+def test_count_search():
+    assert store.storage.search(u'bag:paged', count=True) == 7
+    assert store.storage.search(u'bag:paged _limit:3', count=True) == 3
+    assert store.storage.search(u'bag:paged', exists=True) is True
+    assert store.storage.search(u'bag:paged title:nothing',
+            exists=True) is False
+    assert index_query(environ, bag=u'paged', _count=True) == 7
+    assert index_query(environ, bag=u'nothing', _exists=True) is False
+
+def test_keyset_bag_listing():
+    bag = Bag(u'paged')
+    tiddlers = list(store.storage.list_bag_tiddlers(bag, limit=4))
+    assert [tiddler.title for tiddler in tiddlers] == [
+            'page0', 'page1', 'page2', 'page3']
+    tiddlers = list(store.storage.list_bag_tiddlers(bag,
+        after=after_token(tiddlers[-1]), limit=4))
+    assert [tiddler.title for tiddler in tiddlers] == [
+            'page4', 'page5', 'page6']
+
+def test_relevance_sort():
+    # Without fulltext there is no score, so the usual order is kept.
+    tiddlers = list(store.search(u'starts _sort:relevance _limit:2'))
+    assert len(tiddlers) == 2
+    assert not hasattr(tiddlers[0], 'relevance')
+
+def test_relevance_sort_fulltext():
+    connection = tiddlywebplugins.mysql3.ENGINE.connect()
+    try:
+        add_fulltext(connection, copy=True)
+    finally:
+        connection.close()
+    store.put(Bag(u'relevance'))
+    for title, text in [(u'some', u'quokka wallaby wombat numbat'),
+            (u'best', u'quokka quokka quokka quokka wallaby'),
+            (u'none', u'wombat numbat')]:
+        tiddler = Tiddler(title, u'relevance')
+        tiddler.text = text
+        store.put(tiddler)
+
+    config['mysql.fulltext'] = True
+    try:
+        tiddlers = list(store.search(
+            u'quokka bag:relevance _sort:relevance _limit:5'))
+    finally:
+        del config['mysql.fulltext']
+    assert [tiddler.title for tiddler in tiddlers] == [u'best', u'some']
+    assert tiddlers[0].relevance > tiddlers[1].relevance > 0
+
 def test_modified():
     """
     Note the multiple store.put in here are to create
@@ -285,6 +368,8 @@ def test_or_tags():
     tiddlers = list(store.search(u'@twothing OR tag:one'))
 
     assert len(tiddlers) == 2
+    assert store.storage.search(u'@twothing OR tag:one', count=True) == 2
+    assert len(list(index_query(environ, tag=u'one'))) == 1
 
 def test_at_tags():
     tiddler = Tiddler(u'tagat', u'fnd_public')
@@ -333,3 +418,125 @@ def test_tiddler_field_join():
     tiddlers = list(store.search(u'barney:evil AND soup:good'))
     assert len(tiddlers) == 1
     assert tiddlers[0].title == 'fieldtest'
+
+def test_streamed_search():
+    store_config = dict(config['server_store'][1], stream_results=True)
+    streamer = Store(config['server_store'][0], store_config,
+            {'tiddlyweb.config': config})
+
+    buffered = [(tiddler.bag, tiddler.title)
+            for tiddler in store.search(u'starts')]
+    streamed = [(tiddler.bag, tiddler.title)
+            for tiddler in streamer.search(u'starts')]
+    assert len(streamed) == 3
+    assert streamed == buffered
+
+    buffered = sorted(tiddler.title
+            for tiddler in store.list_bag_tiddlers(Bag(u'fnd_public')))
+    streamed = sorted(tiddler.title
+            for tiddler in streamer.list_bag_tiddlers(Bag(u'fnd_public')))
+    assert streamed == buffered
+
+def test_query_cache():
+    query = u'modifier:fnd NOT (modifier:cdent OR title:GettingStarted)'
+    first = [(tiddler.bag, tiddler.title) for tiddler in store.search(query)]
+    hits = cache_stats()['query']['hits']
+    second = [(tiddler.bag, tiddler.title) for tiddler in store.search(query)]
+    assert second == first
+    assert cache_stats()['query']['hits'] == hits + 1
+
+def test_tiddler_cache():
+    tiddlywebplugins.mysql3.TIDDLER_CACHE = LRUCache(10)
+    try:
+        store.put(Bag(u'tiddlercache'))
+        tiddler = Tiddler(u'cached', u'tiddlercache')
+        tiddler.text = u'one'
+        store.put(tiddler)
+
+        assert store.get(Tiddler(u'cached', u'tiddlercache')).text == u'one'
+        assert store.get(Tiddler(u'cached', u'tiddlercache')).text == u'one'
+        assert cache_stats()['tiddler']['hits'] == 1
+
+        # A write on another thread, as from another process, with
+        # the stale entry left in the cache.
+        key = store.storage._cache_key(tiddler)
+        stale = tiddlywebplugins.mysql3.TIDDLER_CACHE.get(key)
+        def put():
+            tiddler = Tiddler(u'cached', u'tiddlercache')
+            tiddler.text = u'two'
+            get_store(config).put(tiddler)
+        thread = threading.Thread(target=put)
+        thread.start()
+        thread.join()
+        tiddlywebplugins.mysql3.TIDDLER_CACHE.put(key, stale)
+
+        assert store.get(Tiddler(u'cached', u'tiddlercache')).text == u'two'
+    finally:
+        tiddlywebplugins.mysql3.TIDDLER_CACHE = None
+
+def test_search_cache():
+    tiddlywebplugins.mysql3.SEARCH_CACHE = LRUCache(10)
+    try:
+        query = u'bag:cachebag modifier:fnd'
+        store.put(Bag(u'cachebag'))
+        tiddler = Tiddler(u'cached1', u'cachebag')
+        tiddler.modifier = u'fnd'
+        store.put(tiddler)
+
+        assert [t.title for t in store.search(query)] == ['cached1']
+        assert [t.title for t in store.search(query)] == ['cached1']
+        assert cache_stats()['search']['hits'] == 1
+
+        tiddler = Tiddler(u'cached2', u'cachebag')
+        tiddler.modifier = u'fnd'
+        store.put(tiddler)
+        assert sorted(t.title for t in store.search(query)) == [
+                'cached1', 'cached2']
+
+        store.delete(Tiddler(u'cached1', u'cachebag'))
+        assert [t.title for t in store.search(query)] == ['cached2']
+        assert cache_stats()['search']['hits'] == 1
+    finally:
+        tiddlywebplugins.mysql3.SEARCH_CACHE = None
+
+def test_search_cache_unconfined():
+    tiddlywebplugins.mysql3.SEARCH_CACHE = LRUCache(10)
+    try:
+        query = u'modifier:unconfined'
+        store.put(Bag(u'unconfined1'))
+        store.put(Bag(u'unconfined2'))
+        tiddler = Tiddler(u'first', u'unconfined1')
+        tiddler.modifier = u'unconfined'
+        store.put(tiddler)
+
+        assert [t.title for t in store.search(query)] == ['first']
+        assert [t.title for t in store.search(query)] == ['first']
+        hits = cache_stats()['search']['hits']
+
+        # A write to any bag is seen, without a row for all bags.
+        tiddler = Tiddler(u'second', u'unconfined2')
+        tiddler.modifier = u'unconfined'
+        store.put(tiddler)
+        assert sorted(t.title for t in store.search(query)) == [
+                'first', 'second']
+        assert cache_stats()['search']['hits'] == hits
+        assert store.storage.session.query(sBagGeneration).filter(
+                sBagGeneration.bag == u'').count() == 0
+    finally:
+        tiddlywebplugins.mysql3.SEARCH_CACHE = None
+
+def test_search_cache_max_results():
+    tiddlywebplugins.mysql3.SEARCH_CACHE = LRUCache(10)
+    config['mysql.search_cache_max_results'] = 1
+    try:
+        store.put(Bag(u'bigresult'))
+        for title in [u'big1', u'big2']:
+            store.put(Tiddler(title, u'bigresult'))
+
+        assert len(list(store.search(u'bag:bigresult'))) == 2
+        assert cache_stats()['search']['size'] == 0
+        assert len(list(store.search(u'bag:bigresult _limit:1'))) == 1
+        assert cache_stats()['search']['size'] == 1
+    finally:
+        del config['mysql.search_cache_max_results']
+        tiddlywebplugins.mysql3.SEARCH_CACHE = None
@@ -0,0 +1,110 @@
+import py.test
+
+from tiddlyweb.config import config
+from tiddlyweb.store import Store, NoBagError
+
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.model.bag import Bag
+
+from tiddlywebplugins.utils import get_store
+
+import tiddlywebplugins.mysql3
+
+from tiddlywebplugins.mysql3 import Base, after_token
+from tiddlywebplugins.mysql3.shard import HashRing
+
+BAGS = [u'bag%d' % index for index in range(8)]
+
+
+def setup_module(module):
+    get_store(config)
+    db_config = config['server_store'][1]['db_config']
+    tiddlywebplugins.mysql3.ENGINE.execute(
+            'CREATE DATABASE IF NOT EXISTS tiddlywebmysqlshard '
+            'CHARACTER SET utf8')
+    shards = [db_config,
+            db_config.replace('tiddlywebmysql', 'tiddlywebmysqlshard')]
+    module.environ = {'tiddlyweb.config': config}
+    module.store = Store('tiddlywebplugins.mysql3.shard',
+            {'shards': shards}, module.environ)
+    module.environ['tiddlyweb.store'] = module.store
+# delete everything
+    for shard in module.store.storage.shards:
+        Base.metadata.drop_all(shard.database.engine)
+        Base.metadata.create_all(shard.database.engine)
+
+
+def test_hash_ring():
+    names = [u'bag%d' % index for index in range(1000)]
+    two = HashRing(2)
+    three = HashRing(3)
+
+    assert set(two.shard(name) for name in names) == set([0, 1])
+    assert two.shard(u'Bag1') == two.shard(u'bag1')
+    moved = [name for name in names if two.shard(name) != three.shard(name)]
+    assert 0 < len(moved) < 500
+    assert set(three.shard(name) for name in moved) == set([2])
+
+
+def test_routing():
+    storage = store.storage
+    for index, name in enumerate(BAGS):
+        store.put(Bag(name))
+        tiddler = Tiddler(u'tiddler%d' % index, name)
+        tiddler.text = u'hello %d' % index
+        tiddler.tags = [u'shared']
+        tiddler.modified = u'2012010100000%d' % index
+        store.put(tiddler)
+
+    assert sorted(bag.name for bag in store.list_bags()) == BAGS
+    used = set()
+    for index, name in enumerate(BAGS):
+        shard = storage.shard(name)
+        used.add(shard)
+        for other in storage.shards:
+            if other is not shard:
+                py.test.raises(NoBagError, other.bag_get, Bag(name))
+        tiddler = store.get(Tiddler(u'tiddler%d' % index, name))
+        assert tiddler.text == u'hello %d' % index
+    assert len(used) == 2
+
+
+def test_search_merge():
+    tiddlers = list(store.search(u'tag:shared _limit:3'))
+    assert [tiddler.title for tiddler in tiddlers] == [
+            u'tiddler7', u'tiddler6', u'tiddler5']
+
+    tiddlers = list(store.search(u'tag:shared _sort:key _limit:3'))
+    assert [tiddler.bag for tiddler in tiddlers] == BAGS[:3]
+
+    assert store.storage.search(u'tag:shared', count=True) == len(BAGS)
+    assert store.storage.search(u'tag:shared _limit:3', count=True) == 3
+    assert store.storage.search(u'tag:shared', exists=True)
+
+    tiddlers = list(tiddlywebplugins.mysql3.index_query(environ,
+        tag=u'shared'))
+    assert sorted(tiddler.text for tiddler in tiddlers) == sorted(
+            u'hello %d' % index for index in range(len(BAGS)))
+
+
+def test_search_merge_collation():
+    # In the order of the utf8_general_ci collation, which weighs
+    # letters in upper case without accents, and is not that of
+    # lower(): the names are on both shards.
+    names = [u'Alpha', u'beta', u'\xc9clair', u'eclairs', u'zeta',
+            u'_under']
+    assert len(set(store.storage.shard(name) for name in names)) == 2
+    for name in reversed(names):
+        store.put(Bag(name))
+        tiddler = Tiddler(u'collated', name)
+        tiddler.tags = [u'collated']
+        store.put(tiddler)
+
+    tiddlers = list(store.search(u'tag:collated _sort:key _limit:10'))
+    assert [tiddler.bag for tiddler in tiddlers] == names
+
+    tiddlers = list(store.search(u'tag:collated _sort:key _limit:3'))
+    assert [tiddler.bag for tiddler in tiddlers] == names[:3]
+    tiddlers = list(store.search(u'tag:collated _after:%s _limit:3'
+        % after_token(tiddlers[-1])))
+    assert [tiddler.bag for tiddler in tiddlers] == names[3:]
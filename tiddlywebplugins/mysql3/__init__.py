@@ -9,17 +9,62 @@ http://tiddlyweb.com/
 """
 from __future__ import absolute_import, with_statement
 
+import json
+import os
+import random
 import warnings
+import zlib
 import MySQLdb
 
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import wraps
+from hashlib import sha256
+from time import time
+from unicodedata import combining, normalize
+
+from MySQLdb.cursors import SSCursor
+from pyparsing import ParseException
+
 from sqlalchemy import event
-from sqlalchemy.engine import create_engine
-from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.engine import Compiled, create_engine
+from sqlalchemy.exc import DisconnectionError, ProgrammingError
+from sqlalchemy.orm import aliased, scoped_session, sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.schema import Index
+from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import (and_, exists as exists_, select,
+        text as text_)
+
+from sqlalchemy.dialects.mysql.base import VARCHAR, LONGBLOB, LONGTEXT
 
-from sqlalchemy.dialects.mysql.base import VARCHAR, LONGTEXT
+from tiddlyweb import control
+from tiddlyweb.control import filter_tiddlers, recipe_template
+from tiddlyweb.filters import FilterIndexRefused
+from tiddlyweb.manage import make_command
+from tiddlyweb.model.bag import Bag
+from tiddlyweb.model.tiddler import Tiddler
+from tiddlyweb.specialbag import SpecialBagError, get_bag_retriever
+from tiddlyweb.store import HOOKS, NoBagError, NoTiddlerError, StoreError
+from tiddlyweb.util import binary_tiddler
 
 from tiddlywebplugins.sqlalchemy3 import (Store as SQLStore, Base, Session,
-        index_query)
+        sBag, sTiddler, sRevision, sText, sTag, sField)
+from tiddlywebplugins.sqlalchemy3.model import (current_revision_table,
+        first_revision_table)
+
+from .cache import LRUCache
+from .instrument import TIMINGS, count_statement, timed
+from .migrate import (FULLTEXT, MIGRATIONS, add_fulltext, migrate, plan,
+        schema_version, stamp)
+from .model import (sBagGeneration, sGeo, sRevisionArchive, sRevisionText,
+        sTextBlob, sTextContent)
+from .pool import (TimedQueuePool, after_fork, check_pid, on_checkin,
+        on_connect)
+from .producer import Producer, after_token, parse_after_token
+from .rows import TiddlerRow
 
 import logging
 
@@ -31,20 +76,55 @@ import logging
 __version__ = '3.1.2'
 
 ENGINE = None
+DATABASES = OrderedDict()
 MAPPED = False
+TIDDLER_CACHE = None
+QUERY_CACHE = None
+SEARCH_CACHE = None
+
+CURRENT_REVISION_UPSERT = text_(
+        'INSERT INTO current_revision (tiddler_id, current_id) '
+        'VALUES (:tiddler_id, :current_id) '
+        'ON DUPLICATE KEY UPDATE current_id = VALUES(current_id)')
+
+GENERATION_BUMP = text_(
+        'INSERT INTO bag_generation (bag, generation) VALUES (:bag, 1) '
+        'ON DUPLICATE KEY UPDATE generation = generation + 1')
 
+TEXT_CONTENT_UPSERT = text_(
+        'INSERT INTO text_content (hash, text) VALUES (:hash, :text) '
+        'ON DUPLICATE KEY UPDATE hash = hash')
+
+REVISION_TEXT_UPSERT = text_(
+        'INSERT INTO revision_text (revision_number, hash) '
+        'VALUES (:revision_number, :hash) '
+        'ON DUPLICATE KEY UPDATE hash = VALUES(hash)')
+
+
+CONTROL_GET_TIDDLERS_FROM_RECIPE = control.get_tiddlers_from_recipe
 
 LOGGER = logging.getLogger(__name__)
+SLOW_LOGGER = logging.getLogger(__name__ + '.slow')
 
 
 def on_checkout(dbapi_con, con_record, con_proxy):
     """
     Ensures that MySQL connections checked out of the
-    pool are alive.
+    pool are alive, and belong to this process. Connections
+    which have been idle for less than the ping_idle of the pool
+    are taken to be alive.
 
     Borrowed from:
     http://groups.google.com/group/sqlalchemy/msg/a4ce563d802c929f
     """
+    check_pid(con_record, con_proxy)
+    pool = con_proxy._pool
+    ping_idle = getattr(pool, 'ping_idle', 0)
+    if (ping_idle and
+            time() - con_record.info.get('idle_since', 0) < ping_idle):
+        return
+    if hasattr(pool, 'stats'):
+        pool.stats.pinged()
     try:
         try:
             dbapi_con.ping(False)
@@ -53,12 +133,89 @@ def on_checkout(dbapi_con, con_record, con_proxy):
     except dbapi_con.OperationalError, ex:
         if ex.args[0] in (2006, 2013, 2014, 2045, 2055):
             LOGGER.debug('got mysql server has gone away: %s', ex)
+            if hasattr(pool, 'stats'):
+                pool.stats.disconnected()
             # caught by pool, which will retry with a new connection
             raise DisconnectionError()
         else:
             raise
 
 
+def _make_engine(db_config, store_config):
+    """
+    Create an engine for db_config, with connections checked
+    for liveness on checkout if they have been idle for more
+    than the ping_idle seconds (default 10) of store_config.
+    The pool is sized by the pool_size, max_overflow, pool_timeout
+    and pool_recycle of store_config.
+    """
+    engine = create_engine(db_config,
+            poolclass=TimedQueuePool,
+            ping_idle=float(store_config.get('ping_idle', 10)),
+            pool_recycle=int(store_config.get('pool_recycle', 3600)),
+            pool_size=int(store_config.get('pool_size', 20)),
+            max_overflow=int(store_config.get('max_overflow', -1)),
+            pool_timeout=float(store_config.get('pool_timeout', 2)))
+    event.listen(engine, 'connect', on_connect)
+    event.listen(engine, 'checkin', on_checkin)
+    event.listen(engine, 'checkout', on_checkout)
+    event.listen(engine, 'before_cursor_execute', count_statement)
+    return engine
+
+
+class _Database(object):
+    """
+    The engine and scoped session of one db_config, and the
+    sessions of its db_replicas.
+    """
+
+    def __init__(self, db_config, store_config, session=None):
+        self.db_config = db_config
+        self.pid = os.getpid()
+        self.engine = _make_engine(db_config, store_config)
+        if session is None:
+            session = scoped_session(sessionmaker())
+        session.configure(bind=self.engine)
+        self.session = session
+        self.read_sessions = [scoped_session(sessionmaker(
+            bind=_make_engine(replica, store_config)))
+            for replica in store_config.get('db_replicas', [])]
+
+    def engines(self):
+        """
+        The primary engine followed by those of the db_replicas.
+        """
+        return [self.engine] + [session.session_factory.kw['bind']
+                for session in self.read_sessions]
+
+    def check_fork(self):
+        """
+        If the process has forked since the engines were made,
+        start each with an empty pool and forget the sessions of
+        the parent.
+        """
+        if self.pid == os.getpid():
+            return
+        for engine in self.engines():
+            after_fork(engine)
+        for session in [self.session] + self.read_sessions:
+            session.registry.clear()
+        self.pid = os.getpid()
+
+
+def _writes(method):
+    """
+    Mark a Store method as writing, so that for the rest of the
+    life of the store (which is one request) reads also go to
+    the primary, and see what was written.
+    """
+    @wraps(method)
+    def write(self, *args, **kwargs):
+        self.wrote = True
+        return method(self, *args, **kwargs)
+    return write
+
+
 class Store(SQLStore):
     """
     An adaptation of the generic sqlalchemy store, to add mysql
@@ -67,31 +224,417 @@ class Store(SQLStore):
 
     def __init__(self, store_config=None, environ=None):
         super(Store, self).__init__(store_config, environ)
+        self.producer = Producer()
         self.has_geo = True
+        self.superseded = []
 
     def _init_store(self):
         """
         Establish the database engine and session,
         creating tables if needed.
-        """
-        global ENGINE, MAPPED
-        if not ENGINE:
-            ENGINE = create_engine(self._db_config(),
-                    pool_recycle=3600,
-                    pool_size=20,
-                    max_overflow=-1,
-                    pool_timeout=2)
-            event.listen(ENGINE, 'checkout', on_checkout)
-            Base.metadata.bind = ENGINE
-            Session.configure(bind=ENGINE)
-        self.session = Session()
 
+        Each db_config gets engines and sessions of its own, made
+        the first time a Store is made for it, so one process can
+        use several databases. The first database made uses the
+        Session of sqlalchemy3, and is bound to Base.metadata and
+        ENGINE.
+        """
+        global ENGINE, MAPPED, TIDDLER_CACHE, QUERY_CACHE, SEARCH_CACHE
+        config = self.environ['tiddlyweb.config']
         if not MAPPED:
-            _map_tables(self.environ['tiddlyweb.config'],
-                    Base.metadata.sorted_tables)
-            Base.metadata.create_all(ENGINE)
+            _map_tables(config, Base.metadata.sorted_tables)
+            cache_size = int(config.get('mysql.tiddler_cache_size', 0))
+            if cache_size:
+                TIDDLER_CACHE = LRUCache(cache_size,
+                        config.get('mysql.tiddler_cache_ttl'))
+            query_cache_size = int(config.get('mysql.query_cache_size', 100))
+            if query_cache_size:
+                QUERY_CACHE = LRUCache(query_cache_size)
+            search_cache_size = int(config.get('mysql.search_cache_size', 0))
+            if search_cache_size:
+                SEARCH_CACHE = LRUCache(search_cache_size,
+                        config.get('mysql.search_cache_ttl'))
             MAPPED = True
 
+        db_config = self._db_config()
+        database = DATABASES.get(db_config)
+        if database is None:
+            if ENGINE is None:
+                database = _Database(db_config, self.store_config, Session)
+                ENGINE = database.engine
+                Base.metadata.bind = ENGINE
+            else:
+                database = _Database(db_config, self.store_config)
+            _create_tables(database.engine)
+            if (config.get('mysql.fulltext', False)
+                    and _fulltext_engine(config) == 'InnoDB'):
+                _check_fulltext(database.engine)
+            DATABASES[db_config] = database
+        else:
+            database.check_fork()
+        self.database = database
+        self.session = database.session()
+        self.wrote = False
+        if database.read_sessions:
+            self.read_session = random.choice(database.read_sessions)()
+        else:
+            self.read_session = None
+
+    @contextmanager
+    def _reading(self):
+        """
+        Use the read session as the session of the store, for the
+        duration.
+        """
+        session = self.session
+        self.session = self._read_session()
+        try:
+            yield
+        finally:
+            self.session = session
+
+    def _read_session(self):
+        """
+        The session for read only operations: on one of the
+        db_replicas, if any are configured and nothing has been
+        written yet by this store.
+        """
+        if self.read_session is None or self.wrote:
+            return self.session
+        return self.read_session
+
+    def _bump_generations(self, bags):
+        """
+        Count a change to the tiddlers in each of bags, invalidating
+        any cached search results which depend on them, in this
+        process or any other.
+
+        This is done in the transaction of the change, so one is
+        never committed without the other. The caller is responsible
+        for committing. Only the rows of bags are locked, in name
+        order, so writes to other bags go on concurrently and writes
+        to the same bags cannot deadlock on them.
+        """
+        if SEARCH_CACHE is None:
+            return
+        try:
+            self.session.execute(GENERATION_BUMP,
+                    [{'bag': bag} for bag in sorted(set(bags))])
+        except:
+            self.session.rollback()
+            raise
+
+    def _generations(self, bags, session):
+        """
+        The current (bag, generation) pairs for bags. Bags which
+        have never changed have no generation. The names are as
+        stored, which under the column collation may differ in case
+        from those asked for.
+
+        Searches not confined to bags depend on all of them: their
+        generation, for the bag u'', is the sum of those of every
+        bag, which goes up with each change to any of them.
+        """
+        table = sBagGeneration.__table__
+        if bags == (u'',):
+            return ((u'', session.execute(select(
+                [func.sum(table.c.generation)])).scalar() or 0),)
+        return tuple(sorted(tuple(row) for row in session.execute(
+            select([table.c.bag, table.c.generation]).where(
+                table.c.bag.in_(bags)))))
+
+    @timed
+    @_writes
+    def bag_delete(self, bag):
+        """
+        Override the super to delete the tiddlers in the bag first,
+        mysql.batch_size (default 1000) at a time, each batch in a
+        transaction of its own, rather than in one cascade from the
+        bag row, and to invalidate cached searches.
+
+        The bag row goes last, so if a batch fails the bag is still
+        there, with the tiddlers not yet deleted, and deleting it
+        again finishes the job.
+        """
+        config = self.environ.get('tiddlyweb.config', {})
+        batch_size = int(config.get('mysql.batch_size', 1000))
+        deleted = 0
+        try:
+            if not self.session.query(sBag.id).filter(
+                    sBag.name == bag.name).count():
+                raise NoBagError('Bag %s not found' % bag.name)
+            while True:
+                tiddler_ids = [tiddler_id for (tiddler_id,) in
+                        self.session.query(sTiddler.id).filter(
+                            sTiddler.bag == bag.name).limit(batch_size)]
+                if not tiddler_ids:
+                    break
+                self._delete_tiddlers(tiddler_ids)
+                self._bump_generations([bag.name])
+                self.session.commit()
+                deleted += len(tiddler_ids)
+            # Committed with the bag row by the super.
+            self._bump_generations([bag.name])
+        except:
+            self.session.rollback()
+            if deleted:
+                LOGGER.warning('bag %s deleted in part, %s tiddlers '
+                        'gone, delete it again to finish', bag.name, deleted)
+            raise
+        SQLStore.bag_delete(self, bag)
+
+    def _delete_tiddlers(self, tiddler_ids):
+        """
+        Delete the tiddlers tiddler_ids and all their revisions.
+        The caller is responsible for committing.
+        """
+        numbers = [number for (number,) in self.session.query(
+            sRevision.number).filter(sRevision.tiddler_id.in_(tiddler_ids))]
+        for table in (current_revision_table, first_revision_table,
+                sGeo.__table__):
+            self.session.execute(table.delete().where(
+                table.c.tiddler_id.in_(tiddler_ids)))
+        if numbers:
+            self._delete_revisions(numbers)
+        self.session.execute(sTiddler.__table__.delete().where(
+            sTiddler.id.in_(tiddler_ids)))
+
+    bag_get = timed(SQLStore.bag_get)
+    bag_put = timed(_writes(SQLStore.bag_put))
+    recipe_delete = timed(_writes(SQLStore.recipe_delete))
+    recipe_get = timed(SQLStore.recipe_get)
+    recipe_put = timed(_writes(SQLStore.recipe_put))
+    user_delete = timed(_writes(SQLStore.user_delete))
+    user_get = timed(SQLStore.user_get)
+    user_put = timed(_writes(SQLStore.user_put))
+    list_bags = timed(SQLStore.list_bags)
+    list_recipes = timed(SQLStore.list_recipes)
+    list_users = timed(SQLStore.list_users)
+
+    @timed
+    @_writes
+    def tiddler_delete(self, tiddler):
+        """
+        Override the super to drop the tiddler from the cache,
+        and invalidate cached searches.
+        """
+        # Committed, or rolled back, with the delete by the super.
+        self._bump_generations([tiddler.bag])
+        SQLStore.tiddler_delete(self, tiddler)
+        if TIDDLER_CACHE is not None:
+            TIDDLER_CACHE.discard(self._cache_key(tiddler))
+
+    @timed
+    def tiddler_get(self, tiddler):
+        """
+        Override the super to read from a replica, and to use
+        the tiddler cache, if mysql.tiddler_cache_size is set.
+
+        A cached tiddler is only used if it is still the current
+        revision, which is checked with one indexed lookup rather
+        than loading the revision, text, tags and fields.
+        """
+        with self._reading():
+            if TIDDLER_CACHE is None or tiddler.revision:
+                return SQLStore.tiddler_get(self, tiddler)
+
+            key = self._cache_key(tiddler)
+            cached = TIDDLER_CACHE.get(key,
+                    lambda cached: cached.revision == self._current_revision(
+                        tiddler))
+            if cached is not None:
+                return _copy_tiddler(cached, tiddler)
+            tiddler = SQLStore.tiddler_get(self, tiddler)
+            TIDDLER_CACHE.put(key, _copy_tiddler(tiddler,
+                Tiddler(tiddler.title, tiddler.bag)))
+            return tiddler
+
+    def _cache_key(self, tiddler):
+        """
+        The key of tiddler in the tiddler cache, which is shared by
+        all the databases of the process.
+        """
+        return (self.database.db_config, tiddler.bag, tiddler.title)
+
+    def _current_revision(self, tiddler):
+        """
+        The current revision number of tiddler, or None if it
+        does not exist. The session is closed afterwards, so the
+        next check does not read from the snapshot of this one.
+        """
+        try:
+            revision = self.session.execute(
+                    select([current_revision_table.c.current_id]).where(
+                        and_(current_revision_table.c.tiddler_id
+                            == sTiddler.id,
+                            sTiddler.bag == tiddler.bag,
+                            sTiddler.title == tiddler.title))).scalar()
+            self.session.close()
+            return revision
+        except:
+            self.session.rollback()
+            raise
+
+    @timed
+    def tiddlers_get_many(self, tiddlers):
+        """
+        Load many tiddlers, with a fixed number of queries for each
+        mysql.batch_size tiddlers (default 1000): one for the
+        tiddlers and their current and first revisions and one each
+        for the text, text_blob, tags and fields of those revisions.
+        Tiddlers with a revision set are loaded with tiddler_get.
+
+        Return the loaded tiddlers, in order, leaving out those which
+        do not exist.
+        """
+        config = self.environ.get('tiddlyweb.config', {})
+        batch_size = int(config.get('mysql.batch_size', 1000))
+        loaded = []
+        batch = []
+        for tiddler in tiddlers:
+            batch.append(tiddler)
+            if len(batch) >= batch_size:
+                loaded.extend(self._get_batch(batch))
+                batch = []
+        if batch:
+            loaded.extend(self._get_batch(batch))
+        return loaded
+
+    def _get_batch(self, tiddlers):
+        """
+        Load one batch of tiddlers, using the tiddler cache for
+        those whose cached revision is still current.
+        """
+        with self._reading():
+            try:
+                revisions = self._current_revisions(
+                        [(tiddler.bag, tiddler.title) for tiddler in tiddlers
+                            if not tiddler.revision])
+                cached = {}
+                numbers = set()
+                for key, revision in revisions.items():
+                    number = revision[0]
+                    if TIDDLER_CACHE is not None:
+                        cached[key] = TIDDLER_CACHE.get(
+                                (self.database.db_config,) + key,
+                                lambda entry: entry.revision == number)
+                    if cached.get(key) is None:
+                        numbers.add(number)
+                texts, blobs, tags, fields = self._revision_contents(numbers)
+                self.session.close()
+            except:
+                self.session.rollback()
+                raise
+
+            loaded = []
+            for tiddler in tiddlers:
+                key = (tiddler.bag, tiddler.title)
+                if tiddler.revision:
+                    try:
+                        loaded.append(SQLStore.tiddler_get(self, tiddler))
+                    except NoTiddlerError:
+                        pass
+                    continue
+                if key not in revisions:
+                    continue
+                (number, tiddler.type, tiddler.modified, tiddler.modifier,
+                        tiddler.created, tiddler.creator) = revisions[key]
+                if cached.get(key) is not None:
+                    loaded.append(_copy_tiddler(cached[key], tiddler))
+                    continue
+                tiddler.revision = number
+                text = texts.get(number)
+                if text and binary_tiddler(tiddler):
+                    text = b64decode(text.strip())
+                if not text and number in blobs:
+                    text = _blob_text(tiddler, *blobs[number])
+                tiddler.text = text or ''
+                tiddler.tags = list(tags.get(number, []))
+                tiddler.fields.update(fields.get(number, {}))
+                if TIDDLER_CACHE is not None:
+                    TIDDLER_CACHE.put(self._cache_key(tiddler),
+                            _copy_tiddler(tiddler,
+                                Tiddler(tiddler.title, tiddler.bag)))
+                loaded.append(tiddler)
+            return loaded
+
+    def _current_revisions(self, keys):
+        """
+        Map (bag, title) keys to the number, type, modified and
+        modifier of the current revision of the tiddler, and the
+        modified and modifier of its first revision.
+        """
+        if not keys:
+            return {}
+        keys = set(keys)
+        current = aliased(sRevision)
+        first = aliased(sRevision)
+        query = self.session.query(sTiddler.bag, sTiddler.title,
+                current.number, current.type, current.modified,
+                current.modifier, first.modified, first.modifier).join(
+                    current_revision_table,
+                    current_revision_table.c.tiddler_id == sTiddler.id).join(
+                        current,
+                        current.number == current_revision_table.c.current_id
+                        ).join(first_revision_table,
+                            first_revision_table.c.tiddler_id
+                            == sTiddler.id).join(first, first.number
+                                == first_revision_table.c.first_id).filter(
+                                    sTiddler.title.in_(set(title for _, title
+                                        in keys))).filter(sTiddler.bag.in_(
+                                            set(bag for bag, _ in keys)))
+        wanted = _collated_keys(keys)
+        revisions = {}
+        for row in query:
+            for key in wanted.get(_collated(row[0], row[1]), []):
+                revisions[key] = tuple(row[2:])
+        return revisions
+
+    def _revision_contents(self, numbers):
+        """
+        Select the text, text_blob data, tags and fields of the
+        revisions numbers, each keyed by revision number. The text
+        of past revisions is read from text_content.
+        """
+        texts = {}
+        blobs = {}
+        tags = {}
+        fields = {}
+        if not numbers:
+            return texts, blobs, tags, fields
+        numbers = list(numbers)
+        texts.update(self.session.query(sText.revision_number,
+            sText.text).filter(sText.revision_number.in_(numbers)))
+        archived = [number for number in numbers if number not in texts]
+        if archived:
+            texts.update(self.session.query(sRevisionText.revision_number,
+                sTextContent.text).filter(
+                    sTextContent.hash == sRevisionText.hash).filter(
+                        sRevisionText.revision_number.in_(archived)))
+        for number, data, compressed in self.session.query(
+                sTextBlob.revision_number, sTextBlob.data,
+                sTextBlob.compressed).filter(
+                    sTextBlob.revision_number.in_(numbers)):
+            blobs[number] = (data, compressed)
+        for number, tag in self.session.query(sTag.revision_number,
+                sTag.tag).filter(sTag.revision_number.in_(numbers)):
+            tags.setdefault(number, []).append(tag)
+        for number, name, value in self.session.query(sField.revision_number,
+                sField.name, sField.value).filter(
+                    sField.revision_number.in_(numbers)):
+            fields.setdefault(number, {})[name] = value
+        return texts, blobs, tags, fields
+
+    @timed
+    def list_tiddler_revisions(self, tiddler):
+        """
+        Override the super to read from a replica.
+        """
+        with self._reading():
+            return SQLStore.list_tiddler_revisions(self, tiddler)
+
+    @timed
+    @_writes
     def tiddler_put(self, tiddler):
         """
         Override the super to trap MySQLdb.Warning which is raised
@@ -103,6 +646,1407 @@ class Store(SQLStore):
             SQLStore.tiddler_put(self, tiddler)
         except MySQLdb.Warning, exc:
             raise TypeError('mysql refuses to store tiddler: %s' % exc)
+        self._after_commit(self._archive_texts, 'mysqltext',
+                self.superseded)
+        if self.store_config.get('revision_retention', {}).get('on_write'):
+            self._after_commit(self.prune_revisions, 'mysqlprune', tiddler)
+
+    @timed
+    @_writes
+    def tiddlers_put_many(self, tiddlers):
+        """
+        Store many tiddlers, committing once per mysql.batch_size
+        tiddlers (default 1000) and writing each table with one
+        multi-row INSERT per batch.
+
+        Return a list of (tiddler, exception) pairs for those tiddlers
+        which could not be stored: because their bag does not exist
+        (NoBagError) or because mysqld would truncate them (TypeError,
+        as with tiddler_put). All other tiddlers are stored and have
+        their revision set.
+        """
+        config = self.environ.get('tiddlyweb.config', {})
+        batch_size = int(config.get('mysql.batch_size', 1000))
+        warnings.simplefilter('error', MySQLdb.Warning)
+        failures = []
+        batch = []
+        for tiddler in tiddlers:
+            batch.append(tiddler)
+            if len(batch) >= batch_size:
+                failures.extend(self._put_batch(batch))
+                batch = []
+        if batch:
+            failures.extend(self._put_batch(batch))
+        return failures
+
+    def _put_batch(self, tiddlers):
+        """
+        Store one batch of tiddlers in one transaction. If mysqld
+        warns during the batch, roll it back and store the tiddlers
+        one at a time so the warning can be reported against the
+        tiddler which caused it.
+        """
+        failures = []
+        try:
+            bags = set(tiddler.bag for tiddler in tiddlers if tiddler.bag)
+            if bags:
+                bags = set(_collate(name) for (name,) in self.session.query(
+                    sBag.name).filter(sBag.name.in_(bags)))
+            storable = []
+            for tiddler in tiddlers:
+                if tiddler.bag and _collate(tiddler.bag) in bags:
+                    storable.append(tiddler)
+                else:
+                    failures.append((tiddler, NoBagError(
+                        'bag %s must exist for tiddler save' % tiddler.bag)))
+            try:
+                if storable:
+                    self._store_tiddlers(storable)
+                self.session.commit()
+                if storable:
+                    self._after_commit(self._archive_texts, 'mysqltext',
+                            self.superseded)
+                return failures
+            except MySQLdb.Warning, exc:
+                LOGGER.debug('batch put refused, storing singly: %s', exc)
+                self.session.rollback()
+        except:
+            self.session.rollback()
+            raise
+
+        for tiddler in storable:
+            try:
+                self.tiddler_put(tiddler)
+            except TypeError, exc:
+                failures.append((tiddler, exc))
+        return failures
+
+    def _after_commit(self, work, command, *args):
+        """
+        Call work with args, housekeeping after a write which has
+        already been committed. The write has succeeded whatever
+        happens here, so a failure (a lock wait timeout, say) is
+        logged rather than raised, which would have the client
+        retry the write, and the work is left for twanager command.
+        """
+        try:
+            work(*args)
+        except Exception, exc:
+            LOGGER.warning('%s failed after commit, leaving it for '
+                    'twanager %s: %s', work.__name__, command, exc)
+
+    def _store_tiddler(self, tiddler):
+        """
+        Override the super to write through the same multi-row
+        INSERT path as tiddlers_put_many, avoiding the ORM unit
+        of work.
+        """
+        return self._store_tiddlers([tiddler])[0]
+
+    def _store_tiddlers(self, tiddlers):
+        """
+        Write a new revision of each of tiddlers, with one INSERT
+        per table, and bump the generations of their bags. Bags must
+        already exist. The caller is responsible for committing.
+        Return the new revision numbers, in order.
+
+        The numbers of the revisions which stopped being current are
+        left in superseded, for _archive_texts once committed.
+        """
+        keys = [(tiddler.bag, tiddler.title) for tiddler in tiddlers]
+        tiddler_ids = self._tiddler_ids(keys)
+        new_keys = set(keys) - set(tiddler_ids)
+        if new_keys:
+            # One row for keys which only differ in case.
+            self.session.execute(sTiddler.__table__.insert(),
+                    [{'bag': variants[0][0], 'title': variants[0][1]}
+                        for variants in _collated_keys(new_keys).values()])
+            tiddler_ids.update(self._tiddler_ids(new_keys))
+
+        config = self.environ.get('tiddlyweb.config', {})
+        threshold = int(config.get('mysql.compress_threshold', 0))
+        texts = []
+        blobs = []
+        revision_rows = []
+        for tiddler in tiddlers:
+            if binary_tiddler(tiddler):
+                texts.append(unicode(b64encode(tiddler.text)))
+            else:
+                texts.append(tiddler.text)
+            blobs.append(_blob(tiddler, threshold))
+            revision_rows.append({
+                'tiddler_id': tiddler_ids[(tiddler.bag, tiddler.title)],
+                'type': tiddler.type,
+                'modified': tiddler.modified,
+                'modifier': tiddler.modifier})
+        if len(revision_rows) == 1:
+            result = self.session.execute(sRevision.__table__.insert(),
+                    revision_rows[0])
+            numbers = [result.lastrowid]
+        else:
+            numbers = self._insert_revisions(revision_rows)
+
+        text_rows = []
+        blob_rows = []
+        tag_rows = []
+        field_rows = []
+        current_rows = {}
+        first_rows = {}
+        geo_rows = {}
+        for tiddler, text, blob, number in zip(tiddlers, texts, blobs,
+                numbers):
+            tiddler_id = tiddler_ids[(tiddler.bag, tiddler.title)]
+            if blob:
+                blob_rows.append(dict(blob, revision_number=number))
+                text = u''
+            text_rows.append({'revision_number': number, 'text': text})
+            for tag in set(tiddler.tags):
+                tag_rows.append({'revision_number': number, 'tag': tag})
+            for name, value in tiddler.fields.iteritems():
+                if not name.startswith('server.'):
+                    field_rows.append({'revision_number': number,
+                        'name': name, 'value': value})
+            current_rows[tiddler_id] = number
+            geo_rows[tiddler_id] = _geo_row(tiddler_id, tiddler.fields)
+            if (tiddler.bag, tiddler.title) in new_keys:
+                first_rows.setdefault(tiddler_id, number)
+
+        self.session.execute(sText.__table__.insert(), text_rows)
+        if blob_rows:
+            self.session.execute(sTextBlob.__table__.insert(), blob_rows)
+        if tag_rows:
+            self.session.execute(sTag.__table__.insert(), tag_rows)
+        if field_rows:
+            self.session.execute(sField.__table__.insert(), field_rows)
+        superseded = set(numbers) - set(current_rows.itervalues())
+        existing_ids = [tiddler_ids[key] for key in set(keys) - new_keys]
+        if existing_ids:
+            superseded.update(number for (number,) in self.session.execute(
+                select([current_revision_table.c.current_id]).where(
+                    current_revision_table.c.tiddler_id.in_(existing_ids))))
+        self.session.execute(CURRENT_REVISION_UPSERT,
+                [{'tiddler_id': tiddler_id, 'current_id': number}
+                    for tiddler_id, number in current_rows.iteritems()])
+        if first_rows:
+            self.session.execute(first_revision_table.insert(),
+                    [{'tiddler_id': tiddler_id, 'first_id': number}
+                        for tiddler_id, number in first_rows.iteritems()])
+        self.session.execute(sGeo.__table__.delete().where(
+            sGeo.tiddler_id.in_(geo_rows.keys())))
+        geo_rows = [row for row in geo_rows.itervalues() if row]
+        if geo_rows:
+            self.session.execute(sGeo.__table__.insert(), geo_rows)
+        self._bump_generations(tiddler.bag for tiddler in tiddlers)
+
+        # Only change the tiddlers once everything has been
+        # written, so a refused batch can be retried singly.
+        self.superseded = sorted(superseded)
+        for tiddler, text, number in zip(tiddlers, texts, numbers):
+            tiddler.text = text
+            tiddler.revision = number
+            if TIDDLER_CACHE is not None:
+                TIDDLER_CACHE.discard(self._cache_key(tiddler))
+        return numbers
+
+    def _archive_texts(self, numbers):
+        """
+        Move the text of the past revisions numbers from the text
+        table to text_content, where revisions with the same text
+        share one row. The text is only removed from text once
+        revision_text points at its copy, and each step can be
+        repeated, so an interrupted move leaves the text readable
+        and is finished by archive_texts.
+        """
+        if not numbers:
+            return
+        text_table = sText.__table__
+        try:
+            texts = [(number, text) for number, text in self.session.execute(
+                select([text_table.c.revision_number, text_table.c.text])
+                .where(text_table.c.revision_number.in_(numbers)))]
+            if not texts:
+                return
+            hashes = [(number, sha256(text.encode('utf-8')).hexdigest())
+                    for number, text in texts]
+            stored = set(digest for (digest,) in self.session.execute(
+                select([sTextContent.hash]).where(sTextContent.hash.in_(
+                    set(digest for _, digest in hashes)))))
+            content_rows = {}
+            for (_, text), (_, digest) in zip(texts, hashes):
+                if digest not in stored:
+                    content_rows[digest] = {'hash': digest, 'text': text}
+            if content_rows:
+                self.session.execute(TEXT_CONTENT_UPSERT,
+                        content_rows.values())
+            self.session.execute(REVISION_TEXT_UPSERT,
+                    [{'revision_number': number, 'hash': digest}
+                        for number, digest in hashes])
+            self.session.commit()
+            self.session.execute(text_table.delete().where(and_(
+                text_table.c.revision_number.in_(
+                    [number for number, _ in texts]),
+                ~text_table.c.revision_number.in_(select(
+                    [current_revision_table.c.current_id])))))
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+    def archive_texts(self, batch_size=1000):
+        """
+        Move the text of every past revision still in the text
+        table to text_content, batch_size revisions at a time, then
+        remove text_content no longer used by any revision. For
+        databases made before text_content existed, and to finish
+        interrupted moves.
+        """
+        text_table = sText.__table__
+        query = select([text_table.c.revision_number]).where(
+                ~text_table.c.revision_number.in_(select(
+                    [current_revision_table.c.current_id]))).order_by(
+                            text_table.c.revision_number).limit(batch_size)
+        last = 0
+        while True:
+            numbers = [number for (number,) in self.session.execute(
+                query.where(text_table.c.revision_number > last))]
+            self.session.commit()
+            if not numbers:
+                break
+            self._archive_texts(numbers)
+            last = numbers[-1]
+        try:
+            self.session.execute(sTextContent.__table__.delete().where(
+                ~sTextContent.hash.in_(select([sRevisionText.hash]))))
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+    def prune_revisions(self, tiddler=None, batch_size=1000):
+        """
+        Delete the revisions the revision_retention policy of the
+        store_config does not keep, of tiddler or, if it is None, of
+        every tiddler, batch_size tiddlers at a time. The policy is
+        a dict: keep, the number of most recent revisions to keep,
+        and days, to keep revisions newer than that, either or both.
+        The first and current revisions are always kept. If archive
+        is true, pruned revisions are copied to revision_archive.
+
+        Return the number of revisions pruned.
+        """
+        policy = self.store_config.get('revision_retention', {})
+        keep = policy.get('keep')
+        days = policy.get('days')
+        if keep is None and days is None:
+            return 0
+        cutoff = None
+        if days is not None:
+            cutoff = (datetime.utcnow() - timedelta(days=days)).strftime(
+                    '%Y%m%d%H%M%S')
+
+        if tiddler is not None:
+            batches = [[tiddler_id for tiddler_id in
+                self._tiddler_ids([(tiddler.bag, tiddler.title)]).values()]]
+        else:
+            batches = self._tiddler_id_batches(batch_size)
+
+        pruned = 0
+        for tiddler_ids in batches:
+            if not tiddler_ids:
+                continue
+            numbers = self._prunable(tiddler_ids, keep, cutoff)
+            if numbers:
+                self._prune(numbers, policy.get('archive', False))
+                pruned += len(numbers)
+        return pruned
+
+    def check_current_revisions(self, repair=False, batch_size=1000):
+        """
+        Find the tiddlers whose current_revision row, which searches
+        and filters join to rather than looking for the highest
+        revision of each tiddler, is missing or does not point at
+        their highest numbered revision, batch_size tiddlers at a
+        time. If repair is true, point them at it.
+
+        Return a list of (tiddler id, current revision, highest
+        revision) for those tiddlers.
+        """
+        wrong = []
+        for tiddler_ids in self._tiddler_id_batches(batch_size):
+            try:
+                highest = dict(self.session.query(sRevision.tiddler_id,
+                    func.max(sRevision.number)).filter(
+                        sRevision.tiddler_id.in_(tiddler_ids)).group_by(
+                            sRevision.tiddler_id))
+                current = dict(self.session.execute(select(
+                    [current_revision_table.c.tiddler_id,
+                        current_revision_table.c.current_id]).where(
+                            current_revision_table.c.tiddler_id.in_(
+                                tiddler_ids))).fetchall())
+                batch = [(tiddler_id, current.get(tiddler_id), number)
+                        for tiddler_id, number in sorted(highest.items())
+                        if current.get(tiddler_id) != number]
+                if repair and batch:
+                    self.session.execute(CURRENT_REVISION_UPSERT,
+                            [{'tiddler_id': tiddler_id, 'current_id': number}
+                                for tiddler_id, _, number in batch])
+                    self._bump_generations(bag for (bag,) in
+                            self.session.query(sTiddler.bag).filter(
+                                sTiddler.id.in_([tiddler_id for tiddler_id,
+                                    _, _ in batch])).distinct())
+                    self.session.commit()
+                else:
+                    self.session.commit()
+            except:
+                self.session.rollback()
+                raise
+            wrong.extend(batch)
+        return wrong
+
+    def _tiddler_id_batches(self, batch_size):
+        """
+        Yield the ids of all tiddlers, batch_size at a time.
+        """
+        last = 0
+        while True:
+            tiddler_ids = [tiddler_id for (tiddler_id,) in
+                    self.session.query(sTiddler.id).filter(
+                        sTiddler.id > last).order_by(sTiddler.id).limit(
+                            batch_size)]
+            self.session.commit()
+            if not tiddler_ids:
+                break
+            yield tiddler_ids
+            last = tiddler_ids[-1]
+
+    def _prunable(self, tiddler_ids, keep, cutoff):
+        """
+        The revision numbers of the tiddlers tiddler_ids which are
+        neither among the keep most recent, nor modified after
+        cutoff, nor the first or current revision.
+        """
+        kept = set()
+        for table, column in ((current_revision_table, 'current_id'),
+                (first_revision_table, 'first_id')):
+            kept.update(number for (number,) in self.session.execute(
+                select([table.c[column]]).where(
+                    table.c.tiddler_id.in_(tiddler_ids))))
+        numbers = []
+        seen = {}
+        for tiddler_id, number, modified in self.session.query(
+                sRevision.tiddler_id, sRevision.number,
+                sRevision.modified).filter(sRevision.tiddler_id.in_(
+                    tiddler_ids)).order_by(sRevision.tiddler_id,
+                        sRevision.number.desc()):
+            seen[tiddler_id] = seen.get(tiddler_id, 0) + 1
+            if number in kept:
+                continue
+            if keep is not None and seen[tiddler_id] <= keep:
+                continue
+            if cutoff is not None and (modified or '') > cutoff:
+                continue
+            numbers.append(number)
+        self.session.commit()
+        return numbers
+
+    def _prune(self, numbers, archive):
+        """
+        Delete the revisions numbers, and their text, tags and
+        fields, first copying them to revision_archive if archive
+        is true. The copies are read with a fixed number of queries,
+        in the transaction of the delete.
+        """
+        try:
+            if archive:
+                texts, blobs, tags, fields = self._revision_contents(numbers)
+                rows = []
+                for number, bag, title, mime_type, modified, modifier in (
+                        self.session.query(sRevision.number, sTiddler.bag,
+                            sTiddler.title, sRevision.type,
+                            sRevision.modified, sRevision.modifier).join(
+                                sTiddler,
+                                sTiddler.id == sRevision.tiddler_id).filter(
+                                    sRevision.number.in_(numbers))):
+                    tiddler = Tiddler(title, bag)
+                    tiddler.type = mime_type
+                    text = texts.get(number)
+                    if not text and number in blobs:
+                        text = _blob_text(tiddler, *blobs[number])
+                        if binary_tiddler(tiddler):
+                            text = unicode(b64encode(text))
+                    rows.append({'number': number, 'bag': bag,
+                        'title': title, 'modifier': modifier,
+                        'modified': modified, 'type': mime_type,
+                        'tags': unicode(json.dumps(tags.get(number, []))),
+                        'fields': unicode(json.dumps(
+                            fields.get(number, {}))),
+                        'text': text or u''})
+                if rows:
+                    self.session.execute(sRevisionArchive.__table__.insert(),
+                            rows)
+            self._delete_revisions(numbers)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+    def _delete_revisions(self, numbers):
+        """
+        Delete the revisions numbers, with their text, tags and
+        fields. The caller is responsible for committing.
+        """
+        # The text table may be MyISAM, which does not cascade.
+        for table in (sText.__table__, sTag.__table__, sField.__table__,
+                sRevisionText.__table__, sTextBlob.__table__):
+            self.session.execute(table.delete().where(
+                table.c.revision_number.in_(numbers)))
+        self.session.execute(sRevision.__table__.delete().where(
+            sRevision.number.in_(numbers)))
+
+    def _load_tiddler(self, tiddler, current_revision, base_revision):
+        """
+        Override the super to read the text of past revisions from
+        text_content, and that of binary and compressed tiddlers
+        from text_blob.
+        """
+        tiddler = SQLStore._load_tiddler(self, tiddler, current_revision,
+                base_revision)
+        if current_revision.text is None:
+            text = self.session.execute(select([sTextContent.text]).where(
+                and_(sTextContent.hash == sRevisionText.hash,
+                    sRevisionText.revision_number
+                    == current_revision.number))).scalar()
+            if text is not None:
+                if binary_tiddler(tiddler):
+                    tiddler.text = b64decode(text.strip())
+                else:
+                    tiddler.text = text
+        if not tiddler.text:
+            blob = self.session.execute(select([sTextBlob.data,
+                sTextBlob.compressed]).where(sTextBlob.revision_number
+                    == current_revision.number)).first()
+            if blob is not None:
+                tiddler.text = _blob_text(tiddler, *blob)
+        return tiddler
+
+    def _tiddler_ids(self, keys):
+        """
+        Map (bag, title) keys to existing tiddler ids, using the
+        title index.
+        """
+        wanted = _collated_keys(keys)
+        bags = set(bag for bag, _ in keys)
+        titles = set(title for _, title in keys)
+        tiddler_ids = {}
+        for tiddler_id, bag, title in self.session.query(sTiddler.id,
+                sTiddler.bag, sTiddler.title).filter(
+                        sTiddler.title.in_(titles)).filter(
+                                sTiddler.bag.in_(bags)):
+            for key in wanted.get(_collated(bag, title), []):
+                tiddler_ids[key] = tiddler_id
+        return tiddler_ids
+
+    def _insert_revisions(self, revision_rows):
+        """
+        Insert revision_rows with one multi-row INSERT and recover
+        the auto increment numbers they were given. These are not
+        necessarily consecutive (innodb_autoinc_lock_mode = 2), so
+        they are read back: per tiddler, in insertion order, above
+        the highest number that existed before the INSERT.
+        """
+        highest = self.session.query(func.max(sRevision.number)).scalar()
+        self.session.execute(sRevision.__table__.insert(), revision_rows)
+        tiddler_ids = set(row['tiddler_id'] for row in revision_rows)
+        numbers = {}
+        for number, tiddler_id in self.session.query(sRevision.number,
+                sRevision.tiddler_id).filter(
+                        sRevision.number > (highest or 0)).filter(
+                                sRevision.tiddler_id.in_(tiddler_ids)
+                                ).order_by(sRevision.number):
+            numbers.setdefault(tiddler_id, []).append(number)
+        return [numbers[row['tiddler_id']].pop(0) for row in revision_rows]
+
+    def sync_geo(self, batch_size=1000):
+        """
+        Rebuild the geo table from the geo.lat and geo.long fields
+        of the current revision of every tiddler. tiddler_put keeps
+        it up to date, so this is only needed for tiddlers stored
+        before the table existed.
+        """
+        lat_field = aliased(sField)
+        long_field = aliased(sField)
+        query = (self.session.query(current_revision_table.c.tiddler_id,
+            lat_field.value, long_field.value)
+            .join(lat_field, and_(lat_field.revision_number
+                == current_revision_table.c.current_id,
+                lat_field.name == u'geo.lat'))
+            .join(long_field, and_(long_field.revision_number
+                == current_revision_table.c.current_id,
+                long_field.name == u'geo.long')))
+        try:
+            self.session.execute(sGeo.__table__.delete())
+            rows = []
+            for tiddler_id, latitude, longitude in query.yield_per(
+                    batch_size):
+                row = _geo_row(tiddler_id,
+                        {u'geo.lat': latitude, u'geo.long': longitude})
+                if row:
+                    rows.append(row)
+                if len(rows) >= batch_size:
+                    self.session.execute(sGeo.__table__.insert(), rows)
+                    rows = []
+            if rows:
+                self.session.execute(sGeo.__table__.insert(), rows)
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+
+    @timed
+    def list_bag_tiddlers(self, bag, after=None, limit=None, rows=False):
+        """
+        Override the super to select only titles, and to stream
+        them from the server when stream_results is set.
+
+        If limit is given, list at most that many tiddlers. If after,
+        a token from after_token, is given, list the tiddlers which
+        follow it in title order. Together they page through a bag
+        with index range scans.
+
+        If rows is true, list TiddlerRows rather than tiddlers.
+        """
+        session = self._read_session()
+        try:
+            try:
+                session.query(sBag.id).filter(sBag.name == bag.name).one()
+            except NoResultFound, exc:
+                raise NoBagError('no results for bag %s, %s' % (bag.name, exc))
+            session.close()
+        except:
+            session.rollback()
+            raise
+
+        statement = select([sTiddler.title]).where(sTiddler.bag == bag.name)
+        if after or limit:
+            statement = statement.order_by(sTiddler.title)
+        if after:
+            after_bag, after_title = parse_after_token(after)
+            if after_bag != bag.name:
+                raise StoreError('_after token is not from bag %s' % bag.name)
+            statement = statement.where(sTiddler.title > after_title)
+        if limit:
+            statement = statement.limit(limit)
+        tiddlers = self._bag_titles(statement, session, bag.name)
+        if rows:
+            return self._tiddler_rows(tiddlers)
+        return tiddlers
+
+    def _bag_titles(self, statement, session, bag_name):
+        """
+        Yield a tiddler for each title selected by statement,
+        closing the session once they are all read, or the listing
+        is abandoned, so no transaction (and its snapshot) is left
+        open on the thread.
+        """
+        try:
+            for row in self._rows(statement, session):
+                yield Tiddler(row['title'], bag_name)
+        finally:
+            session.close()
+
+    @timed
+    def recipe_tiddlers(self, recipe_bags, environ=None):
+        """
+        List the tiddlers of a recipe, given as the (bag, filter)
+        pairs of Recipe.get_recipe: for each title, the tiddler in
+        the last bag which has it, as
+        control.get_tiddlers_from_recipe does.
+
+        The bags without a filter are resolved together, in one
+        query which selects the titles in all of them along with the
+        position of their bag in the recipe. Bags with a filter, and
+        special bags, are listed and filtered one at a time.
+        """
+        if environ is None:
+            environ = self.environ
+        recipe_bags = list(recipe_bags)
+        positions = {}
+        for position, (bag, filter_string) in enumerate(recipe_bags):
+            if (isinstance(bag, basestring) and not filter_string
+                    and not get_bag_retriever(environ, bag)):
+                positions[bag] = position
+        titles = self._recipe_titles(positions) if positions else {}
+
+        tiddlers = {}
+        for position, (bag, filter_string) in enumerate(recipe_bags):
+            if position in titles:
+                for title in titles[position]:
+                    tiddlers[title] = Tiddler(title, bag)
+                continue
+            elif (isinstance(bag, basestring)
+                    and positions.get(bag, position) > position):
+                # The same bag, unfiltered, later in the recipe.
+                continue
+            if isinstance(bag, basestring):
+                bag = Bag(bag)
+            retriever = get_bag_retriever(environ, bag.name)
+            try:
+                if retriever:
+                    candidates = retriever[0](bag.name)
+                else:
+                    candidates = self.list_bag_tiddlers(bag)
+                for tiddler in filter_tiddlers(candidates, filter_string,
+                        environ=environ):
+                    tiddlers[tiddler.title] = tiddler
+            except SpecialBagError, exc:
+                raise NoBagError('unable to retrieve from special bag: %s, %s'
+                        % (bag.name, exc))
+        return tiddlers.values()
+
+    def _recipe_titles(self, positions):
+        """
+        Select the titles in the bags keyed in positions, grouped by
+        the position of their bag. Raise NoBagError if a bag does not
+        exist.
+        """
+        # Bag names which differ only by case are one bag to mysql,
+        # so its titles go to the position of each of them.
+        indexes = {}
+        for name, index in positions.items():
+            indexes.setdefault(_collate(name), []).append(index)
+        statement = select([sBag.name, sTiddler.title],
+                from_obj=sBag.__table__.outerjoin(sTiddler.__table__,
+                    sTiddler.bag == sBag.name)).where(
+                            sBag.name.in_(positions.keys()))
+        session = self._read_session()
+        titles = {}
+        try:
+            for name, title in session.execute(statement):
+                for index in indexes.get(_collate(name), []):
+                    titles.setdefault(index, [])
+                    if title is not None:
+                        titles[index].append(title)
+            session.close()
+        except:
+            session.rollback()
+            raise
+        for name, index in positions.items():
+            if index not in titles:
+                raise NoBagError('no results for bag %s' % name)
+        return titles
+
+    @timed
+    def search(self, search_query='', rows=False, count=False,
+            exists=False):
+        """
+        Do a search of of the database, using the 'q' query,
+        parsed by the parser and turned into a producer.
+
+        Override the super so the results can be streamed
+        from the server when stream_results is set, read
+        from a replica, and cached when mysql.search_cache_size
+        is set. When mysql.search_load is set, the results are
+        loaded, mysql.batch_size at a time, by tiddlers_get_many.
+        If rows is true, the results are TiddlerRows instead.
+
+        If count is true, return the number of results instead,
+        counted by mysqld, or if exists is true, whether there are
+        any. No default _limit applies to these.
+        """
+        if count:
+            return self._search_scalar(search_query, 'count')
+        if exists:
+            return self._search_scalar(search_query, 'exists')
+        config = self.environ.get('tiddlyweb.config', {})
+        results = self._search(search_query)
+        if rows:
+            return self._tiddler_rows(results)
+        if config.get('mysql.search_load', False):
+            return self._load_results(results)
+        return results
+
+    def _load_results(self, results):
+        """
+        Yield the search results loaded with tiddlers_get_many,
+        marked as loaded by the store of the environ.
+        """
+        config = self.environ.get('tiddlyweb.config', {})
+        batch_size = int(config.get('mysql.batch_size', 1000))
+        store = self.environ.get('tiddlyweb.store')
+        batch = []
+        for tiddler in results:
+            batch.append(tiddler)
+            if len(batch) >= batch_size:
+                for loaded in self.tiddlers_get_many(batch):
+                    yield _stored(store, loaded)
+                batch = []
+        for loaded in self.tiddlers_get_many(batch):
+            yield _stored(store, loaded)
+
+    def _tiddler_rows(self, tiddlers):
+        """
+        Yield a TiddlerRow for each of tiddlers which exists,
+        selecting their current revisions and tags mysql.batch_size
+        at a time.
+        """
+        config = self.environ.get('tiddlyweb.config', {})
+        batch_size = int(config.get('mysql.batch_size', 1000))
+        batch = []
+        for tiddler in tiddlers:
+            batch.append(tiddler)
+            if len(batch) >= batch_size:
+                for row in self._row_batch(batch):
+                    yield row
+                batch = []
+        for row in self._row_batch(batch):
+            yield row
+
+    def _row_batch(self, tiddlers):
+        """
+        Make the TiddlerRows for one batch of tiddlers.
+        """
+        if not tiddlers:
+            return []
+        with self._reading():
+            try:
+                revisions = self._current_revisions(
+                        [(tiddler.bag, tiddler.title) for tiddler in tiddlers])
+                tags = {}
+                numbers = [revision[0] for revision in revisions.values()]
+                if numbers:
+                    for number, tag in self.session.query(
+                            sTag.revision_number, sTag.tag).filter(
+                                sTag.revision_number.in_(numbers)):
+                        tags.setdefault(number, []).append(tag)
+                self.session.close()
+            except:
+                self.session.rollback()
+                raise
+        rows = []
+        for tiddler in tiddlers:
+            try:
+                (number, tiddler_type, modified,
+                        modifier) = revisions[(tiddler.bag, tiddler.title)][:4]
+            except KeyError:
+                continue
+            rows.append(TiddlerRow(self, tiddler.title, tiddler.bag, number,
+                tiddler_type, modifier, modified, tags.get(number, []),
+                getattr(tiddler, 'relevance', None)))
+        return rows
+
+    def row_text(self, row):
+        """
+        Load the text of the revision of the TiddlerRow row.
+        """
+        with self._reading():
+            try:
+                text = self.session.query(sText.text).filter(
+                        sText.revision_number == row.revision).scalar()
+                if text is None:
+                    text = self.session.execute(select([sTextContent.text
+                        ]).where(and_(sTextContent.hash == sRevisionText.hash,
+                            sRevisionText.revision_number
+                            == row.revision))).scalar()
+                blob = None
+                if not text:
+                    blob = self.session.execute(select([sTextBlob.data,
+                        sTextBlob.compressed]).where(
+                            sTextBlob.revision_number == row.revision)
+                        ).first()
+                self.session.close()
+            except:
+                self.session.rollback()
+                raise
+        if blob is not None:
+            return _blob_text(row, *blob)
+        if text and binary_tiddler(row):
+            return b64decode(text.strip())
+        return text or ''
+
+    def _search(self, search_query):
+        """
+        Yield the results of search_query, as tiddlers with only
+        their bag and title (and relevance, if sorted by it) set.
+        """
+        session = self._read_session()
+        config = self.environ.get('tiddlyweb.config', {})
+        if '_limit:' not in search_query:
+            default_limit = config.get('mysql.search_limit',
+                    config.get('sqlalchemy3.search_limit', '20'))
+            search_query += ' _limit:%s' % default_limit
+        key = (search_query, bool(config.get('mysql.fulltext', False)),
+                self.has_geo, None)
+        try:
+            statement, bags = self._search_statement(key, session)
+            if SEARCH_CACHE is not None:
+                generations = self._generations(bags, session)
+                cached = SEARCH_CACHE.get(self._search_key(key),
+                        lambda entry: entry[0] == generations)
+                if cached is not None:
+                    session.close()
+                    for result in cached[1]:
+                        yield _search_result(*result)
+                    return
+
+            # Results are only kept for the cache, and only up to
+            # mysql.search_cache_max_results, so streamed searches
+            # stay in flat memory.
+            results = None
+            if SEARCH_CACHE is not None:
+                results = []
+                max_results = int(config.get(
+                    'mysql.search_cache_max_results', 1000))
+            started = time()
+            try:
+                for row in self._rows(statement, session):
+                    if started is not None:
+                        self._log_slow(search_query, statement, session,
+                                time() - started)
+                        started = None
+                    result = (unicode(row['bag']), unicode(row['title']),
+                            row['revision'], row.get('relevance'),
+                            row['modified'], row.get('greatcircle'))
+                    if results is not None:
+                        if len(results) < max_results:
+                            results.append(result)
+                        else:
+                            results = None
+                    yield _search_result(*result)
+                if started is not None:
+                    self._log_slow(search_query, statement, session,
+                            time() - started)
+                session.close()
+            except (ProgrammingError, MySQLdb.ProgrammingError), exc:
+                raise StoreError('generated search SQL incorrect: %s' % exc)
+            if results is not None:
+                SEARCH_CACHE.put(self._search_key(key),
+                        (generations, results))
+        except:
+            session.rollback()
+            raise
+
+    def _search_scalar(self, search_query, mode):
+        """
+        Count the results of search_query, if mode is 'count', or
+        tell whether there are any, if mode is 'exists', with one
+        SELECT COUNT(*) or SELECT EXISTS. Cached like search results.
+        """
+        session = self._read_session()
+        config = self.environ.get('tiddlyweb.config', {})
+        key = (search_query, bool(config.get('mysql.fulltext', False)),
+                self.has_geo, mode)
+        try:
+            statement, bags = self._search_statement(key, session)
+            if SEARCH_CACHE is not None:
+                generations = self._generations(bags, session)
+                cached = SEARCH_CACHE.get(self._search_key(key),
+                        lambda entry: entry[0] == generations)
+                if cached is not None:
+                    session.close()
+                    return cached[1]
+
+            started = time()
+            try:
+                value = session.connection().execute(statement).scalar()
+            except (ProgrammingError, MySQLdb.ProgrammingError), exc:
+                raise StoreError('generated search SQL incorrect: %s' % exc)
+            self._log_slow(search_query, statement, session,
+                    time() - started)
+            session.close()
+        except:
+            session.rollback()
+            raise
+        if mode == 'exists':
+            value = bool(value)
+        if SEARCH_CACHE is not None:
+            SEARCH_CACHE.put(self._search_key(key), (generations, value))
+        return value
+
+    def _search_key(self, key):
+        """
+        The key in the search cache, which is shared by all the
+        databases of the process, of the search with statement key.
+        """
+        return (self.database.db_config,) + key
+
+    def _search_statement(self, key, session):
+        """
+        Parse the search query of key and produce it into SQL
+        compiled for the database, or get that from the query cache
+        if the same search has been done before. Return the
+        compiled statement and the bags the results are confined
+        to, for the search cache. The mode of key, if not None,
+        makes the statement count the results ('count') or check
+        there are any ('exists').
+
+        The compiled statement (which holds its bind parameters)
+        is what is cached, rather than the ast, as the producer
+        annotates the ast as it goes.
+        """
+        if QUERY_CACHE is not None:
+            cached = QUERY_CACHE.get(key)
+            if cached is not None:
+                return cached
+        search_query, fulltext, geo, mode = key
+        query = session.query(sTiddler).join('current').add_columns(
+                sRevision.number.label(u'revision'),
+                sRevision.modified.label(u'modified'))
+        try:
+            ast = self.parser(search_query)[0]
+            query = self.producer.produce(ast, query, fulltext=fulltext,
+                    geo=geo)
+        except ParseException, exc:
+            raise StoreError('failed to parse search query: %s' % exc)
+        # Joins to tags or fields (under OR, say) give a row for
+        # each match: DISTINCT makes it one row per tiddler, before
+        # any LIMIT, and so before counting.
+        statement = query.statement.distinct()
+        if mode == 'count':
+            statement = select([func.count()]).select_from(
+                    statement.order_by(None).alias())
+        elif mode == 'exists':
+            statement = select([exists_(query.statement.order_by(None))])
+        compiled = statement.compile(dialect=session.get_bind().dialect)
+        # Results which may come from any bag depend on the
+        # generation of all tiddlers, kept under the empty name.
+        bags = tuple(sorted(self.producer.bags)) or (u'',)
+        if QUERY_CACHE is not None:
+            QUERY_CACHE.put(key, (compiled, bags))
+        return compiled, bags
+
+    def _log_slow(self, search_query, compiled, session, seconds):
+        """
+        If the first result of search_query took longer than
+        mysql.slow_query_time seconds to arrive, log the search, its
+        SQL, bind parameters and EXPLAIN to the slow query log.
+        """
+        config = self.environ.get('tiddlyweb.config', {})
+        threshold = config.get('mysql.slow_query_time')
+        if threshold is None or seconds < float(threshold):
+            return
+        params = [compiled.params[name] for name in compiled.positiontup]
+        sql = unicode(compiled)
+        cursor = session.connection().connection.cursor()
+        try:
+            count_statement()
+            cursor.execute('EXPLAIN ' + sql, params)
+            explain = cursor.fetchall()
+        except MySQLdb.Error, exc:
+            explain = exc
+        finally:
+            cursor.close()
+        SLOW_LOGGER.warning('%.3fs for search %r\nSQL: %s\nparams: %r\n'
+                'EXPLAIN: %r', seconds, search_query, sql, params, explain)
+
+    def _rows(self, statement, session):
+        """
+        Execute statement in session, yielding each row as a dict
+        keyed by column name.
+
+        If the stream_results store_config option is set, use a
+        server side cursor (MySQLdb's SSCursor) on a connection of
+        its own, so rows are yielded as mysqld sends them rather
+        than after the whole result has been buffered in the client.
+        Memory use then stays flat regardless of the size of the
+        result.
+        """
+        if not self.store_config.get('stream_results', False):
+            if isinstance(statement, Compiled):
+                result = session.connection().execute(statement)
+            else:
+                result = session.execute(statement)
+            keys = result.keys()
+            for row in result.fetchall():
+                yield dict(zip(keys, row))
+            return
+
+        engine = session.get_bind()
+        if isinstance(statement, Compiled):
+            compiled = statement
+        else:
+            compiled = statement.compile(dialect=engine.dialect)
+        params = [compiled.params[name] for name in compiled.positiontup]
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor(SSCursor)
+            try:
+                count_statement()
+                cursor.execute(unicode(compiled), params)
+                keys = [column[0] for column in cursor.description]
+                for row in iter(cursor.fetchone, None):
+                    yield dict(zip(keys, [_decode(value,
+                        engine.dialect.encoding) for value in row]))
+            finally:
+                cursor.close()
+        finally:
+            connection.close()
+
+
+def init(config):
+    """
+    Establish the mysql3 twanager commands. Add
+    tiddlywebplugins.mysql3 to twanager_plugins to use them.
+
+    Also have recipes resolved by Store.recipe_tiddlers. Add
+    tiddlywebplugins.mysql3 to system_plugins for this.
+    """
+    control.get_tiddlers_from_recipe = get_tiddlers_from_recipe
+
+    def _store():
+        """Get our Store from config."""
+        return Store(config['server_store'][1], {'tiddlyweb.config': config})
+
+    @make_command()
+    def mysqlgeo(args):
+        """Rebuild the near: search index from geo.lat and geo.long fields."""
+        _store().sync_geo()
+
+    @make_command()
+    def mysqltext(args):
+        """Move the text of past revisions to the shared text_content table."""
+        _store().archive_texts()
+
+    @make_command()
+    def mysqlcurrent(args):
+        """Check the current_revision pointers, fixing them with 'repair'."""
+        wrong = _store().check_current_revisions(repair='repair' in args)
+        for tiddler_id, current_id, number in wrong:
+            print 'tiddler %s: current %s, highest %s' % (tiddler_id,
+                    current_id, number)
+
+    @make_command()
+    def mysqlmigrate(args):
+        """Apply migrations: dry lists them, copy allows table copies."""
+        connection = _store().database.engine.connect()
+        try:
+            if 'dry' in args:
+                for number, description, statements in plan(connection):
+                    print '%s: %s' % (number, description)
+                    for statement in statements:
+                        print '    %s' % statement
+                return
+            version = connection.execute('SELECT VERSION()').scalar()
+            migrate(connection, online=_version_number(version) >= (5, 6),
+                    copy='copy' in args, log=LOGGER.info)
+            print 'schema version %s' % schema_version(connection)
+        finally:
+            connection.close()
+
+    @make_command()
+    def mysqlfulltext(args):
+        """Add the InnoDB FULLTEXT index, copy allows a table copy."""
+        connection = _store().database.engine.connect()
+        try:
+            version = connection.execute('SELECT VERSION()').scalar()
+            if add_fulltext(connection,
+                    online=_version_number(version) >= (5, 6),
+                    copy='copy' in args, log=LOGGER.info):
+                print 'added FULLTEXT index tiddlytext'
+        finally:
+            connection.close()
+
+    @make_command()
+    def mysqlprune(args):
+        """Delete the revisions the revision_retention policy does not keep."""
+        print _store().prune_revisions()
+
+
+def get_tiddlers_from_recipe(recipe, environ=None):
+    """
+    Replace control.get_tiddlers_from_recipe, resolving the recipe
+    with Store.recipe_tiddlers when the store is a mysql3 Store.
+    """
+    storage = getattr(recipe.store, 'storage', None)
+    if not isinstance(storage, Store):
+        return CONTROL_GET_TIDDLERS_FROM_RECIPE(recipe, environ)
+    return storage.recipe_tiddlers(
+            recipe.get_recipe(recipe_template(environ)), environ)
+
+
+@timed
+def index_query(environ, **kwargs):
+    """
+    The filter index, used when tiddlywebplugins.mysql3 is the
+    indexer. Override the sqlalchemy3 index_query to load all the
+    matching tiddlers with tiddlers_get_many, rather than with one
+    store.get each. With _rows=True, yield TiddlerRows instead.
+    With _count=True return the number of matching tiddlers, or
+    with _exists=True whether there are any.
+    """
+    store = environ['tiddlyweb.store']
+    rows = kwargs.pop('_rows', False)
+    count = kwargs.pop('_count', False)
+    exists = kwargs.pop('_exists', False)
+
+    queries = []
+    for key, value in kwargs.items():
+        if '"' in value:
+            # The parser cannot handle nested quotes.
+            raise FilterIndexRefused('unable to process values with quotes')
+        queries.append('%s:"%s"' % (key, value))
+    query = ' '.join(queries)
+
+    # The search is run before returning, so any error in it
+    # refuses the filter, which tiddlyweb then does in memory.
+    storage = store.storage
+    try:
+        if count or exists:
+            return storage.search(query, count=count, exists=exists)
+        if rows:
+            return list(storage._tiddler_rows(storage._search(query)))
+        tiddlers = storage.tiddlers_get_many(storage._search(query))
+    except StoreError, exc:
+        raise FilterIndexRefused('error in the store: %s' % exc)
+    return (_stored(store, tiddler) for tiddler in tiddlers)
+
+
+def cache_stats():
+    """
+    Report the hits, misses and size of the tiddler, query and
+    search caches, keyed by 'tiddler', 'query' and 'search'. A
+    cache that is not enabled is reported as None.
+    """
+    return dict((name, cache and cache.stats()) for name, cache in
+            (('tiddler', TIDDLER_CACHE), ('query', QUERY_CACHE),
+                ('search', SEARCH_CACHE)))
+
+
+def pool_stats(db_config=None):
+    """
+    Report the connection pool stats of the primary engine, and
+    of each of the db_replicas, of the database db_config (by
+    default the first one used), keyed by 'primary' and 'replicas':
+    checkouts; wait and max_wait, the total and longest seconds
+    spent getting a connection; pings sent; disconnects recovered
+    from; and the connections checked out now, of which overflow
+    are beyond pool_size.
+    """
+    if db_config is None:
+        database = DATABASES and DATABASES.values()[0]
+    else:
+        database = DATABASES.get(db_config)
+    if not database:
+        return None
+    engines = database.engines()
+    return {'primary': engines[0].pool.report(),
+            'replicas': [engine.pool.report() for engine in engines[1:]]}
+
+
+def op_stats():
+    """
+    Report, for each Store operation called so far, the number of
+    calls, the total seconds and SQL statements they took, and a
+    histogram of their latency: (upper bound in milliseconds, calls)
+    pairs, the last bound None.
+    """
+    return TIMINGS.report()
+
+
+def _search_result(bag, title, revision, relevance, modified, distance):
+    """
+    Make the tiddler yielded by search for one result, with its
+    modified, and its distance in metres for near: searches.
+    """
+    tiddler = Tiddler(title, bag)
+    tiddler.modified = modified
+    if relevance is not None:
+        tiddler.relevance = relevance
+    if distance is not None:
+        tiddler.distance = distance
+    return tiddler
+
+
+def _blob(tiddler, threshold):
+    """
+    The text_blob row for tiddler, or None if its text belongs in
+    the text table. Binary tiddlers are stored as bytes, and any
+    content larger than threshold bytes is zlib compressed, if
+    that makes it smaller.
+    """
+    data = tiddler.text or ''
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    compressed = False
+    if threshold and len(data) > threshold:
+        packed = zlib.compress(data)
+        if len(packed) < len(data):
+            data, compressed = packed, True
+    if compressed or binary_tiddler(tiddler):
+        return {'data': data, 'compressed': compressed}
+    return None
+
+
+def _collate(name):
+    """
+    The bag name or title as the case and accent insensitive
+    collation of the bag and tiddler columns (utf8_general_ci)
+    weighs it: without accents, in upper case. Names mysqld takes
+    to be the same collate the same, to match the rows it returns
+    to the names they were selected by, and sort as it sorts them.
+    """
+    return u''.join(character for character in
+            normalize('NFD', unicode(name))
+            if not combining(character)).upper()
+
+
+def _collated(bag, title):
+    """
+    The bag and title of a tiddler, collated as by _collate.
+    """
+    return (_collate(bag), _collate(title))
+
+
+def _collated_keys(keys):
+    """
+    Map the collated form of each of the (bag, title) keys to
+    the keys which have it.
+    """
+    collated = {}
+    for key in set(keys):
+        collated.setdefault(_collated(*key), []).append(key)
+    return collated
+
+
+def _stored(store, tiddler):
+    """
+    Mark tiddler as loaded by store, as store.get would, running
+    the tiddler get hooks.
+    """
+    if store is not None:
+        tiddler.store = store
+        for hook in HOOKS['tiddler']['get']:
+            hook(store, tiddler)
+    return tiddler
+
+
+def _blob_text(tiddler, data, compressed):
+    """
+    The text of tiddler from its text_blob data.
+    """
+    if compressed:
+        data = zlib.decompress(data)
+    if binary_tiddler(tiddler):
+        return data
+    return data.decode('utf-8')
+
+
+def _copy_tiddler(source, target):
+    """
+    Copy the stored attributes of source onto target, so that
+    cached tiddlers are never shared with callers.
+    """
+    target.modifier = source.modifier
+    target.modified = source.modified
+    target.revision = source.revision
+    target.type = source.type
+    target.text = source.text
+    target.tags = list(source.tags)
+    target.fields.update(source.fields)
+    target.created = source.created
+    target.creator = source.creator
+    return target
+
+
+def _fulltext_engine(config):
+    """
+    The storage engine of the text table when mysql.fulltext is on:
+    MyISAM unless mysql.fulltext_engine is InnoDB, which needs
+    MySQL 5.6 or beyond.
+    """
+    if config.get('mysql.fulltext_engine', 'MyISAM').lower() == 'innodb':
+        return 'InnoDB'
+    return 'MyISAM'
+
+
+def _check_fulltext(engine):
+    """
+    Check that the text table is InnoDB with the tiddlytext FULLTEXT
+    index, warning if it is not. Adding the index rebuilds the
+    table, which is left to twanager mysqlfulltext rather than
+    holding up the first request.
+    """
+    connection = engine.connect()
+    try:
+        version = connection.execute('SELECT VERSION()').scalar()
+        if _version_number(version) < (5, 6):
+            raise StoreError('InnoDB fulltext needs MySQL 5.6 or beyond, '
+                    'not %s' % version)
+
+        table_engine = connection.execute(
+                "SELECT ENGINE FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'text'"
+                ).scalar()
+        if table_engine != 'InnoDB':
+            LOGGER.warning('mysql.fulltext_engine is InnoDB but the text '
+                    'table is %s, use ALTER TABLE text ENGINE=InnoDB',
+                    table_engine)
+            return
+
+        if FULLTEXT.needed(connection):
+            LOGGER.warning('the text table has no FULLTEXT index '
+                    'tiddlytext, use twanager mysqlfulltext')
+    finally:
+        connection.close()
+
+
+def _create_tables(engine):
+    """
+    Create any missing tables. A new database is recorded as having
+    had all the migrations applied. For an existing one, warn if
+    migrations are waiting for twanager mysqlmigrate.
+    """
+    connection = engine.connect()
+    try:
+        new = not engine.dialect.has_table(connection, 'tiddler')
+        Base.metadata.create_all(connection)
+        if new:
+            stamp(connection)
+        elif schema_version(connection) < MIGRATIONS[-1][0]:
+            LOGGER.warning('the database schema is at version %s of %s, '
+                    'use twanager mysqlmigrate', schema_version(connection),
+                    MIGRATIONS[-1][0])
+    finally:
+        connection.close()
+
+
+def _version_number(version):
+    """
+    Turn a version string such as 5.6.21-log into (5, 6).
+    """
+    numbers = []
+    for part in version.split('.')[:2]:
+        digits = ''
+        for character in part:
+            if not character.isdigit():
+                break
+            digits += character
+        numbers.append(int(digits or 0))
+    return tuple(numbers)
+
+
+def _geo_row(tiddler_id, fields):
+    """
+    Make a geo table row from the geo.lat and geo.long fields,
+    or None if they are missing or not numbers.
+    """
+    try:
+        latitude = float(fields[u'geo.lat'])
+        longitude = float(fields[u'geo.long'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+        return {'tiddler_id': tiddler_id, 'latitude': latitude,
+                'longitude': longitude}
+    return None
+
+
+def _decode(value, encoding):
+    """
+    Decode the bytestrings returned by a raw cursor.
+    """
+    if isinstance(value, str):
+        return value.decode(encoding)
+    return value
 
 
 def _map_tables(config, tables):
@@ -116,7 +2060,7 @@ def _map_tables(config, tables):
     for table in tables:
 
         if table.name == 'text' and fulltext:
-            table.kwargs['mysql_engine'] = 'MyISAM'
+            table.kwargs['mysql_engine'] = _fulltext_engine(config)
         else:
             table.kwargs['mysql_engine'] = 'InnoDB'
 
@@ -126,11 +2070,18 @@ def _map_tables(config, tables):
                         or column.name == 'title'):
                     column.type = VARCHAR(length=128, convert_unicode=True)
 
-        if table.name == 'text':
+        if table.name == 'tiddler':
+            # for _after: keyset paging by bag and title
+            Index('ix_tiddler_bag_title', table.c.bag, table.c.title)
+
+        if table.name in ('text', 'text_content', 'revision_archive'):
             for column in table.columns:
                 if column.name == 'text':
                     column.type = LONGTEXT(convert_unicode=True)
 
+        if table.name == 'text_blob':
+            table.c.data.type = LONGBLOB()
+
         if table.name == 'tag':
             for column in table.columns:
                 if column.name == 'tag':
@@ -141,3 +2092,6 @@ def _map_tables(config, tables):
                 # XXX: is the naming system reliable?
                 if index.name == 'ix_field_value':
                     index.kwargs['mysql_length'] = 191
+            # for name:value searches on fields
+            Index('ix_field_name_value', table.c.name, table.c.value,
+                    mysql_length={'value': 191})
@@ -0,0 +1,85 @@
+"""
+A small, thread safe, bounded LRU cache with optional expiry,
+used to hold loaded tiddlers and search results in process.
+"""
+
+import threading
+
+from collections import OrderedDict
+from time import time
+
+
+class LRUCache(object):
+    """
+    Map keys to values, holding at most size entries. When full,
+    the least recently used entry is dropped. If ttl (seconds) is
+    set, entries older than that are treated as absent.
+
+    hits and misses count the outcomes of get.
+    """
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, validate=None):
+        """
+        Return the value for key, or None if there is no (live)
+        entry. If validate is given, it is called with the value and
+        a false result discards the entry and counts as a miss.
+        """
+        with self._lock:
+            try:
+                stored, value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if self.ttl and time() - stored > self.ttl:
+                self.misses += 1
+                return None
+            self._entries[key] = (stored, value)
+        if validate is not None and not validate(value):
+            self.discard(key)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Set the value for key, dropping the least recently used
+        entry if the cache is full.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time(), value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        """
+        Remove the entry for key, if there is one.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Report hits, misses and the current number of entries.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries)}
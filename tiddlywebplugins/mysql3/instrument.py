@@ -0,0 +1,132 @@
+"""
+Timing of store operations: for each public Store method, a
+latency histogram and the number of SQL statements it ran.
+"""
+
+import threading
+
+from functools import wraps
+from time import time
+from types import GeneratorType
+
+
+# Upper bounds, in milliseconds, of the histogram buckets. Slower
+# operations fall into a last, unbounded, bucket.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_local = threading.local()
+
+
+class Timings(object):
+    """
+    Per operation counts, total seconds, SQL statements and latency
+    histogram.
+    """
+
+    def __init__(self):
+        self._ops = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, statements):
+        """
+        Count one call of name which took seconds and ran statements.
+        """
+        milliseconds = seconds * 1000
+        bucket = len(BUCKETS)
+        for index, bound in enumerate(BUCKETS):
+            if milliseconds <= bound:
+                bucket = index
+                break
+        with self._lock:
+            op = self._ops.setdefault(name, {'count': 0, 'seconds': 0.0,
+                'statements': 0, 'histogram': [0] * (len(BUCKETS) + 1)})
+            op['count'] += 1
+            op['seconds'] += seconds
+            op['statements'] += statements
+            op['histogram'][bucket] += 1
+
+    def report(self):
+        """
+        Copy out the timings, keyed by operation. Each histogram is
+        a list of (upper bound in milliseconds, count) pairs, the
+        last bound None.
+        """
+        with self._lock:
+            report = {}
+            for name, op in self._ops.items():
+                report[name] = dict(op, histogram=zip(
+                    BUCKETS + (None,), op['histogram']))
+            return report
+
+    def clear(self):
+        """
+        Forget all timings.
+        """
+        with self._lock:
+            self._ops.clear()
+
+
+TIMINGS = Timings()
+
+
+def count_statement(*args):
+    """
+    Count a SQL statement run by this thread. Usable as a
+    before_cursor_execute listener.
+    """
+    _local.statements = statements() + 1
+
+
+def statements():
+    """
+    The number of SQL statements run by this thread so far.
+    """
+    return getattr(_local, 'statements', 0)
+
+
+def timed(method):
+    """
+    Record the latency and statement count of each call of method
+    in TIMINGS, under its name. If it returns a generator, the time
+    spent producing items, until it is exhausted or closed, is what
+    is recorded.
+    """
+    name = method.__name__
+
+    @wraps(method)
+    def timer(*args, **kwargs):
+        start = time()
+        before = statements()
+        try:
+            result = method(*args, **kwargs)
+        except:
+            TIMINGS.record(name, time() - start, statements() - before)
+            raise
+        if isinstance(result, GeneratorType):
+            return _timed_generator(name, result, time() - start,
+                    statements() - before)
+        TIMINGS.record(name, time() - start, statements() - before)
+        return result
+    return timer
+
+
+def _timed_generator(name, generator, seconds, count):
+    """
+    Yield from generator, adding up the time and statements spent
+    in it.
+    """
+    try:
+        while True:
+            start = time()
+            before = statements()
+            try:
+                item = generator.next()
+            except StopIteration:
+                return
+            finally:
+                seconds += time() - start
+                count += statements() - before
+            yield item
+    finally:
+        generator.close()
+        TIMINGS.record(name, seconds, count)
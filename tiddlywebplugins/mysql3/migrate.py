@@ -0,0 +1,252 @@
+"""
+Versioned changes to the schema of databases made by earlier
+releases, which create_all leaves alone once a table exists.
+
+Each migration is a list of steps. A step checks information_schema
+to see if it is still needed, so a migration can be rerun, or run
+against a database which already has some of it. The ALTERs ask for
+ALGORITHM=INPLACE and the lock of their step, LOCK=NONE unless mysqld
+needs more, so tables stay in use while they run. Steps mysqld can
+only do by copying the table are run only if copying is allowed.
+The versions applied are recorded in schema_version.
+
+The FULLTEXT index of an InnoDB text table is only wanted with
+mysql.fulltext on, so rather than being a migration it is added with
+add_fulltext, in the same way.
+"""
+
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+
+from tiddlyweb.store import StoreError
+
+from .model import sSchemaVersion
+
+
+# mysqld refuses ALGORITHM=INPLACE or LOCK=NONE for this ALTER.
+ALTER_NOT_ONLINE = (1845, 1846)
+
+
+class AddIndex(object):
+    """
+    Add the index name on columns (SQL, with any prefix lengths)
+    to table.
+    """
+
+    lock = 'NONE'
+
+    def __init__(self, table, name, columns):
+        self.table = table
+        self.name = name
+        self.columns = columns
+
+    def needed(self, connection):
+        return not connection.execute(
+                "SELECT COUNT(*) FROM information_schema.STATISTICS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+                "AND INDEX_NAME = %s", (self.table, self.name)).scalar()
+
+    def alter(self, connection):
+        return 'ADD INDEX `%s` (%s)' % (self.name, self.columns)
+
+
+class AddFulltextIndex(AddIndex):
+    """
+    Add the FULLTEXT index name on columns to table. The first
+    FULLTEXT index of an InnoDB table rebuilds it, which mysqld
+    can do in place, but not without blocking writes.
+    """
+
+    lock = 'SHARED'
+
+    def alter(self, connection):
+        return 'ADD FULLTEXT INDEX `%s` (%s)' % (self.name, self.columns)
+
+
+class ModifyColumn(object):
+    """
+    Change column of table to column_type, with the rest of
+    definition, keeping its character set and collation. mysqld
+    copies the table to change the type of a column.
+    """
+
+    lock = None
+
+    def __init__(self, table, column, column_type, definition=''):
+        self.table = table
+        self.column = column
+        self.column_type = column_type
+        self.definition = definition
+
+    def needed(self, connection):
+        column = self._column(connection)
+        return (column is not None
+                and column[0].lower() != self.column_type.lower())
+
+    def alter(self, connection):
+        _, charset, collation = self._column(connection)
+        column_type = self.column_type
+        if charset:
+            column_type += ' CHARACTER SET %s COLLATE %s' % (charset,
+                    collation)
+        return ('MODIFY COLUMN `%s` %s %s' % (self.column, column_type,
+            self.definition)).strip()
+
+    def _column(self, connection):
+        """
+        The type, character set and collation of the column.
+        """
+        return connection.execute(
+                "SELECT COLUMN_TYPE, CHARACTER_SET_NAME, COLLATION_NAME "
+                "FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+                "AND COLUMN_NAME = %s", (self.table, self.column)).first()
+
+
+MIGRATIONS = [
+        (1, u'title VARCHAR(128) and tag VARCHAR(191), for utf8mb4 indexes',
+            [ModifyColumn('tiddler', 'title', 'VARCHAR(128)', 'NOT NULL'),
+                ModifyColumn('tag', 'tag', 'VARCHAR(191)', 'NOT NULL')]),
+        (2, u'tiddler (bag, title) index for keyset paging',
+            [AddIndex('tiddler', 'ix_tiddler_bag_title', '`bag`, `title`')]),
+        # There is no tag (tag, revision_number) index: InnoDB
+        # already appends the primary key to ix_tag_tag.
+        (3, u'field (name, value) index for field searches',
+            [AddIndex('field', 'ix_field_name_value',
+                '`name`, `value`(191)')]),
+        ]
+
+FULLTEXT = AddFulltextIndex('text', 'tiddlytext', '`text`')
+
+
+def schema_version(connection):
+    """
+    The highest migration applied to the database, 0 if none.
+    """
+    table = sSchemaVersion.__table__
+    return connection.execute(table.select().with_only_columns(
+        [table.c.version]).order_by(table.c.version.desc()).limit(
+            1)).scalar() or 0
+
+
+def stamp(connection, version=None):
+    """
+    Record the migrations up to version (by default, all of them)
+    as applied, for a database created with the current schema.
+    """
+    for number, description, _ in MIGRATIONS:
+        if version is None or number <= version:
+            _record(connection, number, description)
+
+
+def plan(connection):
+    """
+    List the migrations not yet applied as (version, description,
+    statements), leaving out any ALTERs no longer needed.
+    """
+    return [(number, description, [statement for statement, _ in alters])
+            for number, description, alters in _pending(connection)]
+
+
+def migrate(connection, online=True, copy=False, log=None):
+    """
+    Apply the migrations not yet applied, in order. With online,
+    each ALTER asks for ALGORITHM=INPLACE and the lock of its step.
+    If mysqld cannot do an ALTER that way, or its step can only be
+    done by copying the table, it is run as a plain, table copying,
+    ALTER if copy is true, otherwise StoreError is raised, leaving
+    that and later migrations to be done.
+
+    log, if given, is called with a message before each ALTER.
+    Return the versions applied.
+    """
+    applied = []
+    for number, description, alters in _pending(connection):
+        for statement, lock in alters:
+            if log:
+                log('%s: %s' % (number, statement))
+            _alter(connection, 'migration %s' % number, statement, lock,
+                    online, copy)
+        _record(connection, number, description)
+        applied.append(number)
+    return applied
+
+
+def add_fulltext(connection, online=True, copy=False, log=None):
+    """
+    Add the tiddlytext FULLTEXT index to the text table, if it is
+    missing, as migrate would. Online, the text table can still be
+    read, but writes to it wait until the index is built.
+
+    Return True if the index was added.
+    """
+    if not FULLTEXT.needed(connection):
+        return False
+    statement = _statement(FULLTEXT, connection)
+    if log:
+        log('fulltext: %s' % statement)
+    _alter(connection, 'the fulltext index', statement, FULLTEXT.lock,
+            online, copy)
+    return True
+
+
+def _pending(connection):
+    """
+    List the migrations not yet applied as (version, description,
+    alters), where alters are the (statement, lock) pairs of the
+    steps still needed.
+    """
+    current = schema_version(connection)
+    pending = []
+    for number, description, steps in MIGRATIONS:
+        if number <= current:
+            continue
+        alters = [(_statement(step, connection), step.lock)
+                for step in steps if step.needed(connection)]
+        pending.append((number, description, alters))
+    return pending
+
+
+def _statement(step, connection):
+    """
+    The ALTER TABLE statement of step.
+    """
+    return 'ALTER TABLE `%s` %s' % (step.table, step.alter(connection))
+
+
+def _alter(connection, name, statement, lock, online, copy):
+    """
+    Run statement, the ALTER of name, in place with lock if online,
+    otherwise, or if mysqld refuses to do it that way, as a plain
+    ALTER if copy is true. Raise StoreError if it is not. A lock of
+    None is an ALTER which can only be done by copying the table.
+    """
+    if lock is None:
+        if not copy:
+            raise StoreError('%s copies the table, run it with copy '
+                    'or by hand: %s' % (name, statement))
+    elif online:
+        try:
+            connection.execute(
+                    statement + ', ALGORITHM=INPLACE, LOCK=%s' % lock)
+            return
+        except OperationalError, exc:
+            if exc.orig.args[0] not in ALTER_NOT_ONLINE:
+                raise
+            if not copy:
+                raise StoreError('%s cannot run online, run it with copy '
+                        'or by hand: %s: %s' % (name, statement, exc.orig))
+    elif not copy:
+        raise StoreError('%s needs MySQL 5.6 or beyond to run online, '
+                'run it with copy or by hand: %s' % (name, statement))
+    connection.execute(statement)
+
+
+def _record(connection, number, description):
+    """
+    Note that migration number has been applied.
+    """
+    connection.execute(sSchemaVersion.__table__.insert(), version=number,
+            description=description,
+            applied=datetime.utcnow().strftime('%Y%m%d%H%M%S'))
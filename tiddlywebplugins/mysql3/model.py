@@ -0,0 +1,146 @@
+"""
+Tables added by mysql3 to those of sqlalchemy3, to hold derived
+data which accelerates (or validates cached) searches, the text of
+past revisions and of binary and large tiddlers, pruned revisions,
+and the schema migrations applied.
+"""
+
+from sqlalchemy.schema import Column, ForeignKey, Index
+from sqlalchemy.types import (Boolean, CHAR, Integer, LargeBinary, String,
+        Unicode, UnicodeText)
+
+from sqlalchemy.dialects.mysql.base import DOUBLE
+
+from tiddlywebplugins.sqlalchemy3 import Base
+
+
+class sBagGeneration(Base):
+    """
+    A count of the changes to the tiddlers in a bag, or to all
+    tiddlers for the empty bag name, which validates cached search
+    results.
+    """
+
+    __tablename__ = 'bag_generation'
+
+    bag = Column(Unicode(128), nullable=False, primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<sBagGeneration(%s:%s)>' % (self.bag, self.generation)
+
+
+class sGeo(Base):
+    """
+    The numeric geo.lat and geo.long of the current revision
+    of a tiddler, indexed for bounding box searches by near:.
+    """
+
+    __tablename__ = 'geo'
+    __table_args__ = (
+            Index('ix_geo_latitude_longitude', 'latitude', 'longitude'),)
+
+    tiddler_id = Column(Integer,
+            ForeignKey('tiddler.id', ondelete='CASCADE'),
+            nullable=False, primary_key=True)
+    latitude = Column(DOUBLE, nullable=False)
+    longitude = Column(DOUBLE, nullable=False)
+
+    def __repr__(self):
+        return '<sGeo(%s:%s,%s)>' % (self.tiddler_id, self.latitude,
+                self.longitude)
+
+
+class sTextContent(Base):
+    """
+    The text of past revisions, stored once for each distinct text
+    and keyed by its SHA-256.
+    """
+
+    __tablename__ = 'text_content'
+
+    hash = Column(CHAR(64), nullable=False, primary_key=True)
+    text = Column(UnicodeText(), nullable=False)
+
+    def __repr__(self):
+        return '<sTextContent(%s)>' % self.hash
+
+
+class sRevisionText(Base):
+    """
+    The text_content of a past revision. The current revision of
+    each tiddler has its text in the text table instead, where
+    searches find it.
+    """
+
+    __tablename__ = 'revision_text'
+
+    revision_number = Column(Integer,
+            ForeignKey('revision.number', ondelete='CASCADE'),
+            nullable=False, primary_key=True)
+    hash = Column(CHAR(64), ForeignKey('text_content.hash'),
+            nullable=False, index=True)
+
+    def __repr__(self):
+        return '<sRevisionText(%s:%s)>' % (self.revision_number, self.hash)
+
+
+class sTextBlob(Base):
+    """
+    The content of a binary tiddler, as bytes, or the zlib
+    compressed text of a large one. The text row of the revision
+    is left empty, so it is not searched.
+    """
+
+    __tablename__ = 'text_blob'
+
+    revision_number = Column(Integer,
+            ForeignKey('revision.number', ondelete='CASCADE'),
+            nullable=False, primary_key=True)
+    data = Column(LargeBinary(), nullable=False)
+    compressed = Column(Boolean(), nullable=False, default=False)
+
+    def __repr__(self):
+        return '<sTextBlob(%s)>' % self.revision_number
+
+
+class sRevisionArchive(Base):
+    """
+    A revision removed by pruning, kept whole in one row: tags and
+    fields as JSON, the text of binary tiddlers base64 encoded.
+    """
+
+    __tablename__ = 'revision_archive'
+    __table_args__ = (
+            Index('ix_revision_archive_bag_title', 'bag', 'title'),)
+
+    number = Column(Integer, nullable=False, primary_key=True,
+            autoincrement=False)
+    bag = Column(Unicode(128), nullable=False)
+    title = Column(Unicode(128), nullable=False)
+    modifier = Column(Unicode(128))
+    modified = Column(String(14))
+    type = Column(String(128))
+    tags = Column(UnicodeText(), nullable=False)
+    fields = Column(UnicodeText(), nullable=False)
+    text = Column(UnicodeText(), nullable=False)
+
+    def __repr__(self):
+        return '<sRevisionArchive(%s:%s:%s)>' % (self.bag, self.title,
+                self.number)
+
+
+class sSchemaVersion(Base):
+    """
+    A schema migration (see migrate.py) applied to the database.
+    """
+
+    __tablename__ = 'schema_version'
+
+    version = Column(Integer, nullable=False, primary_key=True,
+            autoincrement=False)
+    description = Column(Unicode(256), nullable=False)
+    applied = Column(String(14), nullable=False)
+
+    def __repr__(self):
+        return '<sSchemaVersion(%s)>' % self.version
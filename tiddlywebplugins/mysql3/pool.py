@@ -0,0 +1,145 @@
+"""
+A QueuePool which keeps the numbers needed to tell when the
+connection pool is the bottleneck, and which remembers how long
+each connection has been idle, so liveness pings can be skipped
+for connections that were in use moments ago, and which process
+made it, so connections are not shared across a fork.
+"""
+
+import os
+import threading
+
+from time import time
+
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import QueuePool
+
+
+# Connections and pools inherited from a parent process. They are
+# kept referenced, never closed, so that the child does not end the
+# parent's sessions on the shared sockets.
+INHERITED = []
+
+
+class PoolStats(object):
+    """
+    Counts for one pool: checkouts, the total and longest time
+    spent waiting for a connection (seconds), pings sent and
+    disconnects recovered from.
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.pings = 0
+        self.disconnects = 0
+        self._lock = threading.Lock()
+
+    def waited(self, seconds):
+        """
+        Count a checkout which waited seconds for its connection.
+        """
+        with self._lock:
+            self.checkouts += 1
+            self.wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def pinged(self):
+        """
+        Count a liveness ping.
+        """
+        with self._lock:
+            self.pings += 1
+
+    def disconnected(self):
+        """
+        Count a dead connection found, and replaced, on checkout.
+        """
+        with self._lock:
+            self.disconnects += 1
+
+
+class TimedQueuePool(QueuePool):
+    """
+    A QueuePool with PoolStats. ping_idle is the number of seconds
+    a connection may sit unused in the pool before it is pinged on
+    checkout.
+    """
+
+    def __init__(self, creator, ping_idle=0, **kw):
+        QueuePool.__init__(self, creator, **kw)
+        self.ping_idle = ping_idle
+        self.stats = PoolStats()
+        self._getting = threading.local()
+
+    def _do_get(self):
+        # QueuePool._do_get calls itself to retry, only time the
+        # outermost call.
+        if getattr(self._getting, 'active', False):
+            return QueuePool._do_get(self)
+        self._getting.active = True
+        start = time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            self._getting.active = False
+            self.stats.waited(time() - start)
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.ping_idle = self.ping_idle
+        pool.stats = self.stats
+        return pool
+
+    def report(self):
+        """
+        Report the stats, along with the connections checked out
+        now and how many of those are overflow beyond pool_size.
+        """
+        stats = self.stats
+        return {'checkouts': stats.checkouts,
+                'wait': stats.wait,
+                'max_wait': stats.max_wait,
+                'pings': stats.pings,
+                'disconnects': stats.disconnects,
+                'checkedout': self.checkedout(),
+                'overflow': max(0, self.overflow())}
+
+
+def on_checkin(dbapi_con, con_record):
+    """
+    Note when a connection went idle.
+    """
+    con_record.info['idle_since'] = time()
+
+
+def on_connect(dbapi_con, con_record):
+    """
+    Note the process a connection belongs to, and that it is idle.
+    """
+    con_record.info['pid'] = os.getpid()
+    on_checkin(dbapi_con, con_record)
+
+
+def check_pid(con_record, con_proxy):
+    """
+    Raise DisconnectionError, which has the pool replace the
+    connection, if it was made in another process, abandoning it
+    without closing it.
+    """
+    if con_record.info.get('pid', os.getpid()) != os.getpid():
+        INHERITED.append(con_record.connection)
+        con_record.connection = con_proxy.connection = None
+        raise DisconnectionError('connection inherited across fork')
+
+
+def after_fork(engine):
+    """
+    Give engine a new, empty pool, abandoning the one inherited
+    from the parent process.
+    """
+    INHERITED.append(engine.pool)
+    pool = engine.pool.recreate()
+    pool.stats = PoolStats()
+    engine.pool = pool
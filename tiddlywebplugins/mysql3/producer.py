@@ -0,0 +1,186 @@
+"""
+Extend the sqlalchemy3 search producer with mysql3 specific
+search terms.
+"""
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from math import cos, degrees, radians, sin
+
+from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import and_, or_, desc, label
+
+from tiddlyweb.store import StoreError
+
+from tiddlywebplugins.sqlalchemy3 import sTiddler, sRevision, sText
+from tiddlywebplugins.sqlalchemy3.producer import Producer as SQLProducer
+
+from .model import sGeo
+
+
+EARTH_RADIUS = 6371000  # metres
+
+
+def after_token(tiddler):
+    """
+    Make the opaque token which, given to _after:, continues
+    a search or bag listing after tiddler.
+    """
+    key = u'%s\x00%s' % (tiddler.bag, tiddler.title)
+    return urlsafe_b64encode(key.encode('utf-8')).rstrip('=')
+
+
+def parse_after_token(token):
+    """
+    Turn an _after: token back into the (bag, title) it was made
+    from.
+    """
+    try:
+        key = urlsafe_b64decode(str(token) + '=' * (-len(token) % 4))
+        bag, title = key.decode('utf-8').split(u'\x00', 1)
+    except (TypeError, ValueError), exc:
+        raise StoreError('malformed _after token %s: %s' % (token, exc))
+    return bag, title
+
+
+class Producer(SQLProducer):
+    """
+    Add these to the terms understood by the sqlalchemy3 producer:
+
+    _sort:key orders the results by bag and title.
+
+    _after:<token> continues a _sort:key ordered search after the
+    tiddler the token was made from (see after_token). Each next
+    page is an index range scan, not an OFFSET, so deep pages are
+    as cheap as the first.
+
+    near:lat,long,radius uses the indexed geo table rather than
+    casting geo.lat and geo.long field values: a bounding box
+    around the point selects candidates from the index, then the
+    exact great circle distance is checked.
+
+    _sort:relevance, when fulltext is on, orders the results by
+    their MATCH ... AGAINST score for the text terms of the search,
+    best first, in the database, so with _limit: only the top
+    results are returned. The score is selected as relevance.
+
+    After produce, bags holds the names of the bags the results are
+    confined to by bag: terms, or is empty if they may come from any
+    bag.
+    """
+
+    def produce(self, ast, query, fulltext=False, geo=False):
+        """
+        Given an ast and an empty query, build that query into a
+        full select, based on the info in the ast.
+        """
+        self.joined_revision = False
+        self.joined_tags = False
+        self.joined_fields = False
+        self.joined_text = False
+        self.in_and = False
+        self.in_or = False
+        self.in_not = False
+        self.limit = None
+        self.limited = False
+        self.sort = None
+        self.after = None
+        self.match_terms = []
+        self.bags = set()
+        self.unconfined = 0
+        self.query = query
+        self.fulltext = fulltext
+        self.geo = geo
+        expressions = self._eval(ast, None)
+        self.query = self.query.filter(expressions)
+        if self.after:
+            bag, title = self.after
+            self.sort = 'key'
+            self.query = self.query.filter(or_(sTiddler.bag > bag,
+                and_(sTiddler.bag == bag, sTiddler.title > title)))
+        if self.sort == 'relevance' and self.fulltext and self.match_terms:
+            relevance = label(u'relevance',
+                    sText.text.match(u' '.join(self.match_terms)))
+            self.query = self.query.add_columns(relevance).order_by(
+                    None).order_by(desc(u'relevance'))
+        elif self.sort == 'key':
+            self.query = self.query.order_by(None).order_by(
+                    sTiddler.bag, sTiddler.title)
+        elif self.limited:
+            self.query = self.query.order_by(sRevision.modified.desc())
+        if self.limit:
+            self.query = self.query.limit(self.limit)
+        return self.query
+
+    def _Word(self, node, fieldname):
+        if fieldname == '_limit':
+            try:
+                self.limit = int(node[0])
+            except ValueError:
+                pass
+            self.limited = True
+            return None
+        elif fieldname == '_sort':
+            self.sort = node[0]
+            return None
+        elif fieldname == '_after':
+            self.after = parse_after_token(node[0])
+            return None
+        elif fieldname == 'near' and self.geo:
+            return self._near(node[0])
+        elif (fieldname in ('bag', 'fbag') and not self.unconfined
+                and isinstance(node[0], basestring) and '*' not in node[0]):
+            self.bags.add(node[0])
+        elif (self.fulltext and not self.in_not
+                and fieldname in (None, 'text')):
+            self.match_terms.append(node[0])
+        return SQLProducer._Word(self, node, fieldname)
+
+    def _Or(self, node, fieldname):
+        self.unconfined += 1
+        try:
+            return SQLProducer._Or(self, node, fieldname)
+        finally:
+            self.unconfined -= 1
+
+    def _Not(self, node, fieldname):
+        self.unconfined += 1
+        try:
+            return SQLProducer._Not(self, node, fieldname)
+        finally:
+            self.unconfined -= 1
+
+    def _near(self, value):
+        """
+        Find tiddlers within radius metres of lat,long, nearest
+        first.
+        """
+        try:
+            lat, long, radius = [float(item)
+                    for item in value.split(',', 2)]
+        except ValueError, exc:
+            raise StoreError(
+                    'failed to parse search query, malformed near: %s'
+                    % exc)
+        self.query = self.query.join(sGeo, sGeo.tiddler_id == sTiddler.id)
+        distance = label(u'greatcircle', (EARTH_RADIUS
+            * func.acos(
+                cos(radians(lat))
+                * func.cos(func.radians(sGeo.latitude))
+                * func.cos(func.radians(sGeo.longitude) - radians(long))
+                + sin(radians(lat))
+                * func.sin(func.radians(sGeo.latitude)))))
+        self.query = self.query.add_columns(distance)
+        self.query = self.query.having(
+                u'greatcircle < %s' % radius).order_by('greatcircle')
+        self.limit = 20  # XXX: make this passable
+
+        lat_delta = degrees(radius / EARTH_RADIUS)
+        expression = sGeo.latitude.between(lat - lat_delta, lat + lat_delta)
+        # Away from the poles and the antimeridian, also bound
+        # the longitude.
+        if abs(lat) + lat_delta < 89:
+            long_delta = lat_delta / cos(radians(abs(lat) + lat_delta))
+            if -180 < long - long_delta and long + long_delta < 180:
+                expression = and_(expression, sGeo.longitude.between(
+                    long - long_delta, long + long_delta))
+        return expression
@@ -0,0 +1,39 @@
+"""
+A compact stand in for a tiddler in listings, which loads its text
+only if it is asked for.
+"""
+
+
+class TiddlerRow(object):
+    """
+    The title, bag, revision, type, modifier, modified and tags of
+    the current revision of a tiddler, and relevance, if a search
+    was sorted by it. text is loaded from the store, and kept, the
+    first time it is read.
+    """
+
+    __slots__ = ('title', 'bag', 'revision', 'type', 'modifier', 'modified',
+            'tags', 'relevance', '_storage', '_text')
+
+    def __init__(self, storage, title, bag, revision, type, modifier,
+            modified, tags, relevance=None):
+        self.title = title
+        self.bag = bag
+        self.revision = revision
+        self.type = type
+        self.modifier = modifier
+        self.modified = modified
+        self.tags = tags
+        self.relevance = relevance
+        self._storage = storage
+        self._text = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self._storage.row_text(self)
+        return self._text
+
+    def __repr__(self):
+        return '<TiddlerRow(%s:%s:%s)>' % (self.bag, self.title,
+                self.revision)
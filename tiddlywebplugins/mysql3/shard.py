@@ -0,0 +1,303 @@
+"""
+A store which spreads bags, with their tiddlers and revisions,
+over several mysql3 databases (shards), picking the shard of each
+bag by a consistent hash of its name. Recipes and users are kept
+in the first shard.
+
+    config['server_store'] = ['tiddlywebplugins.mysql3.shard', {
+        'shards': ['mysql://localhost/tiddlyweb0',
+            'mysql://localhost/tiddlyweb1'],
+        }]
+
+The other store_config options (db_replicas aside) apply to each
+shard. Shards are known by their position in the list, so new ones
+must be added at the end, and moving a bag is up to the operator.
+
+Searches run on every shard at once, in a pool of
+mysql.shard_threads (default 10) threads. Each returns up to the
+_limit: of the search, and the results are merged into the order of
+the search and cut to its _limit:. Setting this module as the
+indexer uses the same fan out for filters.
+"""
+
+from __future__ import absolute_import, with_statement
+
+import os
+import re
+import threading
+
+from bisect import bisect
+from hashlib import md5
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+
+from tiddlyweb.stores import StorageInterface
+
+from . import Store as MySQLStore, _collate, _collated, _stored, index_query
+
+
+# The number of points each shard has on the hash ring.
+REPLICAS = 64
+
+POOL = None
+POOL_PID = None
+POOL_LOCK = threading.Lock()
+
+RINGS = {}
+
+LIMIT_RE = re.compile(r'(?:^|\s)_limit:(\d+)')
+KEY_SORT_RE = re.compile(r'(?:^|\s)(?:_sort:key|_after:)')
+
+__all__ = ['HashRing', 'Store', 'index_query']
+
+
+class HashRing(object):
+    """
+    Consistent hashing of names onto count shards. Each shard has
+    replicas points on a ring of md5 hashes, and a name belongs to
+    the shard of the first point at or after its own hash, so adding
+    a shard moves only the names which now belong to it.
+    """
+
+    def __init__(self, count, replicas=REPLICAS):
+        points = sorted((_hash('shard%d-%d' % (shard, replica)), shard)
+                for shard in range(count) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard(self, name):
+        """
+        The index of the shard name belongs to. Names which differ
+        only in case or accents, which mysqld takes to be the same,
+        go to the same shard.
+        """
+        index = bisect(self.hashes, _hash(_collate(name).lower()))
+        return self.shards[index % len(self.shards)]
+
+
+class Store(StorageInterface):
+    """
+    Route each operation on a bag or tiddler to the mysql3 Store of
+    the shard of the bag, and those on recipes and users to the
+    first.
+    """
+
+    def __init__(self, store_config=None, environ=None):
+        super(Store, self).__init__(store_config, environ)
+        shard_config = dict((key, value) for key, value
+                in self.store_config.items() if key != 'shards')
+        self.shards = [MySQLStore(dict(shard_config, db_config=db_config),
+            environ) for db_config in self.store_config['shards']]
+        count = len(self.shards)
+        if count not in RINGS:
+            RINGS[count] = HashRing(count)
+        self.ring = RINGS[count]
+
+    def shard(self, bag_name):
+        """
+        The mysql3 Store of the shard which holds the bag bag_name.
+        """
+        return self.shards[self.ring.shard(bag_name)]
+
+    def recipe_delete(self, recipe):
+        self.shards[0].recipe_delete(recipe)
+
+    def recipe_get(self, recipe):
+        return self.shards[0].recipe_get(recipe)
+
+    def recipe_put(self, recipe):
+        self.shards[0].recipe_put(recipe)
+
+    def bag_delete(self, bag):
+        self.shard(bag.name).bag_delete(bag)
+
+    def bag_get(self, bag):
+        return self.shard(bag.name).bag_get(bag)
+
+    def bag_put(self, bag):
+        self.shard(bag.name).bag_put(bag)
+
+    def tiddler_delete(self, tiddler):
+        self.shard(tiddler.bag).tiddler_delete(tiddler)
+
+    def tiddler_get(self, tiddler):
+        return self.shard(tiddler.bag).tiddler_get(tiddler)
+
+    def tiddler_put(self, tiddler):
+        self.shard(tiddler.bag).tiddler_put(tiddler)
+
+    def user_delete(self, user):
+        self.shards[0].user_delete(user)
+
+    def user_get(self, user):
+        return self.shards[0].user_get(user)
+
+    def user_put(self, user):
+        self.shards[0].user_put(user)
+
+    def list_recipes(self):
+        return self.shards[0].list_recipes()
+
+    def list_bags(self):
+        return chain(*[shard.list_bags() for shard in self.shards])
+
+    def list_bag_tiddlers(self, bag, *args, **kwargs):
+        return self.shard(bag.name).list_bag_tiddlers(bag, *args, **kwargs)
+
+    def list_users(self):
+        return self.shards[0].list_users()
+
+    def list_tiddler_revisions(self, tiddler):
+        return self.shard(tiddler.bag).list_tiddler_revisions(tiddler)
+
+    def tiddlers_put_many(self, tiddlers):
+        """
+        Store many tiddlers, as the mysql3 Store does, passing each
+        shard mysql.batch_size (default 1000) of its tiddlers at a
+        time. Return the (tiddler, exception) pairs of those which
+        could not be stored.
+        """
+        config = self.environ.get('tiddlyweb.config', {})
+        batch_size = int(config.get('mysql.batch_size', 1000))
+        failures = []
+        batches = {}
+        for tiddler in tiddlers:
+            shard = self.shard(tiddler.bag)
+            batch = batches.setdefault(shard, [])
+            batch.append(tiddler)
+            if len(batch) >= batch_size:
+                failures.extend(shard.tiddlers_put_many(batch))
+                del batch[:]
+        for shard, batch in batches.items():
+            if batch:
+                failures.extend(shard.tiddlers_put_many(batch))
+        return failures
+
+    def tiddlers_get_many(self, tiddlers):
+        """
+        Load many tiddlers, each shard loading its own with
+        tiddlers_get_many. Return them in order, leaving out those
+        which do not exist.
+        """
+        tiddlers = list(tiddlers)
+        positions = {}
+        groups = {}
+        for position, tiddler in enumerate(tiddlers):
+            positions.setdefault((tiddler.bag, tiddler.title), position)
+            groups.setdefault(self.shard(tiddler.bag), []).append(tiddler)
+        loaded = []
+        for shard, group in groups.items():
+            loaded.extend(shard.tiddlers_get_many(group))
+        return sorted(loaded,
+                key=lambda tiddler: positions[(tiddler.bag, tiddler.title)])
+
+    def search(self, search_query='', rows=False, count=False,
+            exists=False):
+        """
+        Search every shard at once and merge the results, as
+        described for the mysql3 Store. Counts are added up, to at
+        most the _limit: of the search, if it has one.
+        """
+        if count:
+            total = sum(self._fan_out(lambda shard: shard.search(
+                search_query, count=True)))
+            match = LIMIT_RE.search(search_query)
+            if match:
+                total = min(total, int(match.group(1)))
+            return total
+        if exists:
+            return any(self._fan_out(lambda shard: shard.search(
+                search_query, exists=True)))
+        config = self.environ.get('tiddlyweb.config', {})
+        results = self._search(search_query)
+        if rows:
+            return self._tiddler_rows(results)
+        if config.get('mysql.search_load', False):
+            store = self.environ.get('tiddlyweb.store')
+            return [_stored(store, tiddler)
+                    for tiddler in self.tiddlers_get_many(results)]
+        return results
+
+    def _search(self, search_query):
+        """
+        Return the merged results of search_query on all the shards,
+        as tiddlers with only their bag, title and modified (and
+        relevance or distance, if sorted by them) set.
+
+        Each shard returns at most the _limit: of the search, in its
+        order: by bag and title, as collated by mysqld, for
+        _sort:key and _after:, by
+        relevance, by distance for near:, otherwise most recently
+        modified first. The results are merged in the same order and
+        the first _limit: of them kept.
+        """
+        config = self.environ.get('tiddlyweb.config', {})
+        match = LIMIT_RE.search(search_query)
+        if match:
+            limit = int(match.group(1))
+        else:
+            limit = int(config.get('mysql.search_limit',
+                config.get('sqlalchemy3.search_limit', '20')))
+            search_query += ' _limit:%s' % limit
+        results = list(chain(*self._fan_out(
+            lambda shard: list(shard._search(search_query)))))
+        if KEY_SORT_RE.search(search_query):
+            results.sort(key=lambda tiddler: _collated(tiddler.bag,
+                tiddler.title))
+        elif results and hasattr(results[0], 'relevance'):
+            results.sort(key=lambda tiddler: tiddler.relevance,
+                    reverse=True)
+        elif results and hasattr(results[0], 'distance'):
+            results.sort(key=lambda tiddler: tiddler.distance)
+        else:
+            results.sort(key=lambda tiddler: tiddler.modified, reverse=True)
+        return results[:limit]
+
+    def _tiddler_rows(self, tiddlers):
+        """
+        Make the TiddlerRows of tiddlers which exist, each shard
+        making its own, in the order of tiddlers.
+        """
+        tiddlers = list(tiddlers)
+        groups = {}
+        for tiddler in tiddlers:
+            groups.setdefault(self.shard(tiddler.bag), []).append(tiddler)
+        rows = {}
+        for shard, group in groups.items():
+            for row in shard._tiddler_rows(group):
+                rows[(row.bag, row.title)] = row
+        return [rows[(tiddler.bag, tiddler.title)] for tiddler in tiddlers
+                if (tiddler.bag, tiddler.title) in rows]
+
+    def _fan_out(self, operation):
+        """
+        Call operation with each shard, in the thread pool when there
+        is more than one, and return the results in shard order.
+        """
+        if len(self.shards) == 1:
+            return [operation(self.shards[0])]
+        config = self.environ.get('tiddlyweb.config', {})
+        return _pool(int(config.get('mysql.shard_threads', 10))).map(
+                operation, self.shards)
+
+
+def _pool(size):
+    """
+    The thread pool shard searches run in, made with size threads
+    on first use in each process.
+    """
+    global POOL, POOL_PID
+    with POOL_LOCK:
+        if POOL is None or POOL_PID != os.getpid():
+            POOL = ThreadPool(size)
+            POOL_PID = os.getpid()
+    return POOL
+
+
+def _hash(name):
+    """
+    The position of name on the hash ring.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return int(md5(name).hexdigest()[:16], 16)